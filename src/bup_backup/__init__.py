@@ -19,5 +19,13 @@ from . import config
 from . import cli
 from . import lvm
 from . import bup
+from . import scheduler
+from . import journal
+from . import metrics
+from . import parity
+from . import watcher
+from . import snapshot_monitor
+from . import snapshot_history
+from . import raw_delta
 
 from . import helpers
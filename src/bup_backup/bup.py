@@ -17,14 +17,26 @@
 
 import subprocess
 import os
+import concurrent.futures
+import collections
+import re
+import sys
+import threading
+import time
 
 from .helpers.abstract_processing_helper import ConfigurationException
 from .helpers.config_helper import ConfigHelper
 from .helpers.workdir import Workdir
+from .parity import ParityGenerator
 
 class Bup:
-    def __init__(self, config, verbose: bool, dry: bool, debug: bool):
+    __INDEX_PROGRESS = re.compile('Indexing: ([0-9]+)')
+    __SAVE_PROGRESS = re.compile('Saving: [0-9.]+% \\(([0-9]+)/([0-9]+)k, ([0-9]+)/([0-9]+) files\\)')
+
+    def __init__(self, config, verbose: bool, dry: bool, debug: bool, journal=None, metrics=None):
         self.config = config
+        self.journal = journal
+        self.metrics = metrics
 
         self.verbose = verbose
         self.dry = dry
@@ -35,6 +47,42 @@ class Bup:
         
         self.bupCmd = self.configHelper.getGlobalOption('bup_cmd', '/usr/bin/bup')
         self.bupFolder = self.configHelper.getGlobalOption('bup_folder', '')
+        self.bupFolderMap = self.__parseBupFolderMap(self.configHelper.getGlobalOption('bup_folder_map', ''))
+        self.saveJobs = max(1, int(self.configHelper.getGlobalOption('save_jobs', 1)))
+        self.indexPerBranch = self.configHelper.getBoolGlobalOption('index_per_branch')
+        self.indexJobs = max(1, int(self.configHelper.getGlobalOption('index_jobs', 1)))
+
+        self.saveExecutor = None
+        self.saveFutures = []
+        self.indexLocks = {}
+        self.indexLocksLock = threading.Lock()
+
+    def __parseBupFolderMap(self, value):
+        ret = {}
+        for entry in value.split(','):
+            entry = entry.strip()
+            if entry == '':
+                continue
+            parts = entry.split(':', 1)
+            if len(parts) != 2 or parts[0].strip() == '' or parts[1].strip() == '':
+                raise ConfigurationException(f"The entry '{entry}' in bup_folder_map is not of the form branch:folder.")
+            ret[parts[0].strip()] = parts[1].strip()
+        return ret
+
+    def getBupFolder(self, branch):
+        return self.bupFolderMap.get(branch, self.bupFolder)
+
+    def __getRepositories(self):
+        repos = {}
+        for branch in self.__getAllBranches():
+            repos.setdefault(self.getBupFolder(branch), []).append(branch)
+        return repos
+
+    def __checkBupFolder(self, bup_folder, name):
+        if not os.path.exists(bup_folder):
+            raise ConfigurationException(f"The {name} configuration ({bup_folder}) does not exist.")
+        if not os.access(bup_folder, os.R_OK+os.X_OK+os.W_OK):
+            raise ConfigurationException(f"The {name} configuration ({bup_folder}) cannot be accessed.")
 
     def check(self):
         bup_cmd = self.bupCmd
@@ -46,113 +94,416 @@ class Bup:
         bup_folder = self.bupFolder
         if bup_folder == '':
             raise ConfigurationException('Configuration variable bup_folder must be provided.')
-        if not os.path.exists(bup_folder):
-            raise ConfigurationException(f"The bup_folder configuration ({bup_folder}) does not exist.")
-        if not os.access(bup_cmd, os.R_OK+os.X_OK+os.W_OK):
-            raise ConfigurationException(f"The bup_folder configuration ({bup_folder}) cannot be accessed.")
+        self.__checkBupFolder(bup_folder, 'bup_folder')
+
+        for branch in self.bupFolderMap.keys():
+            self.__checkBupFolder(self.bupFolderMap[branch], f'bup_folder_map of branch {branch}')
+        
+        for branch in self.__getSavedBranches():
+            if self.__hasGraftedRows(branch):
+                self.__checkGrafts(branch)
+
+    def __getBranchIndices(self, branch):
+        return [i for i in range(0, len(self.config.table)) if self.config.table[i].branch == branch]
+
+    def __hasGraftedRows(self, branch):
+        return any(self.workdir.isGrafted(i) for i in self.__getBranchIndices(branch))
+
+    def __getPathComponents(self, path):
+        return [p for p in path.split('/') if p != '']
+
+    def __checkGrafts(self, branch):
+        for index in self.__getBranchIndices(branch):
+            if not self.workdir.isGrafted(index):
+                continue
+            
+            tableLine = self.config.table[index]
+            if tableLine.type in ('lvm', 'lvm+crypt'):
+                if not self.configHelper.isInPlace(index):
+                    raise ConfigurationException(f"The row {tableLine.source} can only be grafted if it is mounted in place.")
+            elif tableLine.type != 'plain':
+                raise ConfigurationException(f"Rows of type {tableLine.type} cannot be grafted ({tableLine.source}).")
+            
+            targetIndex = self.config.targetIndex
+            if len(targetIndex.getNestedIndices(index)) > 0 or len(targetIndex.getParentIndices(index)) > 0:
+                raise ConfigurationException(f"The grafted row {tableLine.source} must not be nested with other targets of branch {branch}.")
+        
+        # bup save walks the real paths in order and builds the trees on the fly.
+        # Thus, the grafted paths must keep the order of the real paths.
+        grafts = self.__getGrafts(branch)
+        realOrder = sorted(grafts.keys(), key=self.__getPathComponents)
+        graftedOrder = sorted(grafts.keys(), key=lambda p: self.__getPathComponents(grafts[p]))
+        if realOrder != graftedOrder:
+            raise ConfigurationException(f"The order of the targets in branch {branch} does not match the order of their source paths. Put the grafted rows into a separate branch.")
 
     def index(self, base):
         if self.verbose:
             print(f"Indexing working folder {base}.")
         
+        if self.indexPerBranch:
+            # Each branch has its own index, so the branches can be indexed independently.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.indexJobs, thread_name_prefix='index') as executor:
+                futures = [executor.submit(self.indexBranch, base, branch) for branch in self.__getSavedBranches()]
+                concurrent.futures.wait(futures)
+                for f in futures:
+                    f.result()
+            return
+        
+        repos = self.__getRepositories()
+        for repo in repos.keys():
+            stagedPaths = []
+            graftedPaths = []
+            for branch in repos[repo]:
+                stagedPaths = stagedPaths + self.__getStagedPaths(base, branch)
+                graftedPaths = graftedPaths + self.__getGraftedPaths(branch)
+            
+            if len(stagedPaths) > 0:
+                self.__runIndex(repo, stagedPaths)
+            if len(graftedPaths) > 0:
+                self.__runIndex(repo, graftedPaths, oneFileSystem=True)
+
+    def indexBranch(self, base, branch):
+        if self.verbose:
+            print(f"Indexing data of branch \"{branch}\".")
+        
+        indexFile = self.__getIndexFile(branch)
+
+        # In pipelined mode, saves of other branches might use the same index concurrently
+        with self.__getIndexLock(branch):
+            stagedPaths = self.__getStagedPaths(base, branch)
+            if len(stagedPaths) > 0:
+                self.__runIndex(self.getBupFolder(branch), stagedPaths, indexFile=indexFile, branch=branch)
+
+            graftedPaths = self.__getGraftedPaths(branch)
+            if len(graftedPaths) > 0:
+                self.__runIndex(self.getBupFolder(branch), graftedPaths, oneFileSystem=True, indexFile=indexFile, branch=branch)
+
+    def __getIndexFile(self, branch):
+        if self.indexPerBranch:
+            return os.path.join(self.getBupFolder(branch), f'bupindex-{branch}')
+        return None
+
+    def __getIndexLock(self, branch):
+        # bup save writes the hashes back into the index. Rewriting the index in between loses them.
+        indexFile = self.__getIndexFile(branch)
+        if indexFile is None:
+            indexFile = os.path.join(self.getBupFolder(branch), 'bupindex')
+        
+        with self.indexLocksLock:
+            return self.indexLocks.setdefault(indexFile, threading.Lock())
+
+    def __getStagedPaths(self, base, branch):
+        if all(self.workdir.isGrafted(i) or self.workdir.isStreamed(i) for i in self.__getBranchIndices(branch)):
+            return []
+        return [os.path.join(base, branch)]
+
+    def __getGraftedPaths(self, branch):
+        return [self.workdir.getSavePath(i) for i in self.__getBranchIndices(branch) if self.workdir.isGrafted(i)]
+
+    def __runIndex(self, repo, paths, oneFileSystem: bool = False, indexFile: str = None, branch: str = None):
         cmd = [
             self.bupCmd,
-            '-d', self.bupFolder,
-            'index', base,
+            '-d', repo,
+            'index'
+        ] + paths + [
             '--no-check-device'
         ]
 
+        if oneFileSystem:
+            cmd.append('--one-file-system')
+        if indexFile is not None:
+            cmd = cmd + ['--indexfile', indexFile]
+
         if self.debug:
             print('Bup index command line:', cmd)
         
         if self.dry:
             print('Running bup index command.')
         else:
-            if self.verbose:
-                subprocess.run(cmd).check_returncode()
-            else:    
-                sp = subprocess.run(
-                    cmd,
-                    text=True,
-                    stderr=subprocess.STDOUT,
-                    stdout=subprocess.PIPE,
-                )
-                
-                if sp.returncode == 0:
-                    # Everything went smoothly
-                    pass
+            progress = {}
+            tic = time.monotonic()
+            self.__runWithProgress(cmd, 'bup index', lambda line: self.__parseIndexLine(line, progress))
+            duration = time.monotonic() - tic
+
+            if self.metrics is not None:
+                if branch is not None:
+                    branchMetrics = self.metrics.getBranch(branch)
+                    branchMetrics.indexedPaths = (branchMetrics.indexedPaths or 0) + progress.get('paths', 0)
+                    branchMetrics.indexDuration = (branchMetrics.indexDuration or 0) + duration
                 else:
-                    print(sp.stdout)
-                    raise Exception(f"'bup index' terminated with return code {sp.returncode}.")
-                    
+                    self.metrics.addIndexRun(repo, paths, progress.get('paths'), duration)
 
-    def save(self, base):
+    def __parseIndexLine(self, line, progress):
+        match = self.__INDEX_PROGRESS.search(line)
+        if match is not None:
+            progress['paths'] = int(match.group(1))
+
+    def __parseSaveLine(self, line, progress):
+        match = self.__SAVE_PROGRESS.search(line)
+        if match is not None:
+            progress['bytes'] = int(match.group(1)) * 1024
+            progress['files'] = int(match.group(3))
+
+    def __runWithProgress(self, cmd, name, parseLine):
+        # Make bup report its progress although no terminal is attached
+        env = dict(os.environ)
+        env['BUP_FORCE_TTY'] = '2'
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        lastLines = collections.deque(maxlen=50)
+        buffer = b''
+        while True:
+            chunk = proc.stdout.read1(65536)
+            if len(chunk) == 0:
+                break
+            
+            if self.verbose:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            
+            # Progress lines are terminated by carriage returns
+            lines = re.split(b'[\r\n]', buffer + chunk)
+            buffer = lines.pop()
+            for line in lines:
+                line = line.decode(errors='replace')
+                if line != '':
+                    parseLine(line)
+                    lastLines.append(line)
+        
+        if buffer != b'':
+            line = buffer.decode(errors='replace')
+            parseLine(line)
+            lastLines.append(line)
+        
+        proc.stdout.close()
+        returncode = proc.wait()
+        if returncode != 0:
+            if not self.verbose:
+                print('\n'.join(lastLines))
+            raise Exception(f"'{name}' terminated with return code {returncode}.")
+
+    def __getPackSize(self, repo):
+        packFolder = os.path.join(repo, 'objects', 'pack')
+        if not os.path.isdir(packFolder):
+            return 0
+        
+        size = 0
+        with os.scandir(packFolder) as it:
+            for entry in it:
+                if entry.name.endswith('.pack'):
+                    size += entry.stat().st_size
+        return size
+
+    def save(self, base, onBranchSaved=None):
         if self.verbose:
             print('Preparing to save the working folder.')
         
-        cmdStub = [
+        for branch in self.__getAllBranches():
+            self.submitSave(base, branch, onBranchSaved)
+        self.waitForSaves()
+
+    def __saveBranchAndNotify(self, base, branch, onBranchSaved):
+        if branch not in self.__getSavedBranches():
+            # All rows were streamed directly into the repository
+            if onBranchSaved is not None:
+                onBranchSaved(branch)
+            return
+        
+        if self.journal is not None and self.journal.isBranchSaved(branch):
+            if self.verbose:
+                print(f"Branch \"{branch}\" was already saved in a previous run.")
+            return
+        
+        self.saveBranch(base, branch)
+        if self.journal is not None:
+            self.journal.markBranchSaved(branch)
+        if onBranchSaved is not None:
+            onBranchSaved(branch)
+
+    def submitSave(self, base, branch, onBranchSaved=None):
+        if self.saveJobs == 1:
+            self.__saveBranchAndNotify(base, branch, onBranchSaved)
+            return
+        
+        if self.saveExecutor is None:
+            self.saveExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.saveJobs, thread_name_prefix='save')
+        self.saveFutures.append(self.saveExecutor.submit(self.__saveBranchAndNotify, base, branch, onBranchSaved))
+
+    def waitForSaves(self):
+        if self.saveExecutor is None:
+            return
+        
+        futures = self.saveFutures
+        self.saveFutures = []
+        try:
+            # Let all running saves terminate before reporting the first error
+            concurrent.futures.wait(futures)
+            for f in futures:
+                f.result()
+        finally:
+            self.saveExecutor.shutdown(wait=True)
+            self.saveExecutor = None
+
+    def saveBranch(self, base, branch):
+        if self.verbose:
+            print(f"Preparing for saving branch \"{branch}\".")
+        
+        cmd = [
             self.bupCmd,
-            '-d', self.bupFolder,
+            '-d', self.getBupFolder(branch),
             'save',
         ]
 
-        if not self.verbose:
-            cmdStub.append('-q')
-
-        for branch in self.__getAllBranches():
-            if self.verbose:
-                print(f"Preparing for saving branch \"{branch}\".")
-            
-            cmd = cmdStub + ['-n', branch, '--strip', os.path.join(base, branch)]
+        cmd = cmd + ['-n', branch]
+        indexFile = self.__getIndexFile(branch)
+        if indexFile is not None:
+            cmd = cmd + ['--indexfile', indexFile]
+        
+        if self.__hasGraftedRows(branch):
+            grafts = self.__getGrafts(branch)
+            for src in grafts.keys():
+                cmd = cmd + ['--graft', f'{src}={grafts[src]}']
+            cmd = cmd + list(grafts.keys())
+        else:
+            cmd = cmd + ['--strip', os.path.join(base, branch)]
 
-            if self.debug:
-                print('Bup save command line:', cmd)
+        if self.debug:
+            print('Bup save command line:', cmd)
+        
+        if self.dry:
+            print(f'Saving bup for branch "{branch}".')
+        else:
+            repo = self.getBupFolder(branch)
+            # With parallel saves into the same repository the new data cannot be separated exactly.
+            packSize = self.__getPackSize(repo)
+            progress = {}
+            tic = time.monotonic()
+            with self.__getIndexLock(branch):
+                self.__runWithProgress(cmd, 'bup save', lambda line: self.__parseSaveLine(line, progress))
             
-            if self.dry:
-                print(f'Saving bup for branch "{branch}".')
-            else:
-                subprocess.run(
-                    cmd
-                ).check_returncode()
+            if self.metrics is not None:
+                branchMetrics = self.metrics.getBranch(branch)
+                branchMetrics.saveDuration = time.monotonic() - tic
+                branchMetrics.savedFiles = progress.get('files')
+                branchMetrics.savedBytes = progress.get('bytes')
+                branchMetrics.newBytes = self.__getPackSize(repo) - packSize
 
     def __getAllBranches(self):
         branches = [row.branch for row in self.config.table]
-        return set(branches)
+        return sorted(set(branches))
+    
+    def __getSavedBranches(self):
+        branches = [self.config.table[i].branch for i in range(0, len(self.config.table)) if not self.workdir.isStreamed(i)]
+        return sorted(set(branches))
     
     def __getGrafts(self, branch):
         ret = {}
         
         for index in range(0, len(self.config.table)):
-            if self.config.table[index].branch != branch:
+            if self.config.table[index].branch != branch or self.workdir.isStreamed(index):
                 continue
 
             destName = self.config.table[index].target
-            srcName = self.workdir.getWorkingPath(index)
+            srcName = self.workdir.getSavePath(index)
 
             ret[srcName] = destName
         
         return ret
     
-    def finishBackup(self):
+    def getSplitName(self, index):
+        tableLine = self.config.table[index]
+        target = re.sub('[^A-Za-z0-9._-]+', '_', tableLine.target.strip('/'))
+        if target == '':
+            target = 'root'
+        return self.configHelper.getOption(index, 'split_name', f'{tableLine.branch}-{target}')
+
+    def __getGitCmd(self, repo):
+        return [self.configHelper.getGlobalOption('git_cmd', 'git'), '--git-dir', repo]
+
+    def __getRef(self, repo, name):
+        sp = subprocess.run(
+            self.__getGitCmd(repo) + ['rev-parse', '--verify', '-q', f'refs/heads/{name}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        if sp.returncode != 0:
+            return None
+        return sp.stdout.strip()
+
+    def __resetRef(self, repo, name, ref):
         if self.verbose:
-            print('Finishing bup backup process.')
+            print(f'Resetting split branch {name} to its previous state.')
         
+        if ref is None:
+            cmd = self.__getGitCmd(repo) + ['update-ref', '-d', f'refs/heads/{name}']
+        else:
+            cmd = self.__getGitCmd(repo) + ['update-ref', f'refs/heads/{name}', ref]
+        subprocess.run(cmd).check_returncode()
+
+    def getSplitRef(self, index, name=None):
+        if name is None:
+            name = self.getSplitName(index)
+        return self.__getRef(self.getBupFolder(self.config.table[index].branch), name)
+
+    def split(self, index, stdin=None, producer=None, name=None):
+        # Either stdin is an open file handle to read from or the producer writes the data into the pipe.
+        if name is None:
+            name = self.getSplitName(index)
+        repo = self.getBupFolder(self.config.table[index].branch)
+
         cmd = [
-            self.bupCmd, '-d', self.bupFolder,
-            'fsck', '-g'
+            self.bupCmd,
+            '-d', repo,
+            'split',
+            '-n', name
         ]
+        if not self.verbose:
+            cmd.append('-q')
+        
         if self.debug:
-            print('Terminal command', cmd)
+            print('Bup split command line:', cmd)
+        
         if self.dry:
-            print('Generating backup parity blocks')
-        else:
-            sp = subprocess.run(
-                cmd,
-                stderr=subprocess.STDOUT,
-                stdout=subprocess.PIPE,
-                text=True
-            )
-
-            if sp.returncode != 0:
-                print(sp.stdout)
-                raise Exception('Error during bup fsck run. Please revisit your archive.')
+            print(f'Splitting data into branch "{name}".')
+            return
+        
+        oldRef = self.__getRef(repo, name)
+        proc = subprocess.Popen(cmd, stdin=stdin if stdin is not None else subprocess.PIPE)
+        try:
+            if producer is not None:
+                producer(proc.stdin)
+        except BaseException:
+            # Do not keep a commit of incomplete data
+            proc.kill()
+            proc.wait()
+            if stdin is None:
+                proc.stdin.close()
+            self.__resetRef(repo, name, oldRef)
+            raise
+
+        if stdin is None:
+            proc.stdin.close()
+        returncode = proc.wait()
+        if returncode != 0:
+            self.__resetRef(repo, name, oldRef)
+            raise Exception(f"'bup split' terminated with return code {returncode}.")
+
+    def finishBackup(self):
+        if self.verbose:
+            print('Finishing bup backup process.')
+        
+        mode = self.configHelper.getGlobalOption('parity', 'full')
+        if mode not in ('full', 'incremental', 'none'):
+            raise ConfigurationException(f"The parity mode {mode} is unknown.")
+        if mode == 'none':
+            return
+        
+        jobs = int(self.configHelper.getGlobalOption('parity_jobs', 1))
+        detach = self.configHelper.getBoolGlobalOption('parity_detach')
+        logFile = self.configHelper.getGlobalOption('parity_log', '/var/log/bup-backup/parity.log')
+
+        for repo in self.__getRepositories().keys():
+            generator = ParityGenerator(self.bupCmd, repo, jobs, verbose=self.verbose, dry=self.dry, debug=self.debug)
+            if detach:
+                generator.startDetached(mode == 'incremental', logFile)
+            else:
+                generator.generate(mode == 'incremental')
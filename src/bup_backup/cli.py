@@ -30,6 +30,11 @@ class Cli:
         parser.add_argument('-v', '--verbose', help='Be verbose about the tasks involved', action='store_true')
         parser.add_argument('-n', '--dry-run', help='Do not carry out any modifications but only print what would have been done', action='store_true')
         parser.add_argument('--debug', help='Print out some debugging information', action='store_true')
+        parser.add_argument('--pipeline', help='Index and save each branch as soon as all of its rows are prepared', action='store_true')
+        parser.add_argument('--resume', help='Continue an interrupted run based on its journal', action='store_true')
+        parser.add_argument('-b', '--branch', help='Only back up the given branch (can be given multiple times)', action='append', default=[])
+        parser.add_argument('--watch', help='Run as daemon recording the changed folders of the rows with the watch option', action='store_true')
+        parser.add_argument('-j', '--jobs', help='Set the number of table rows to prepare in parallel', nargs=1, type=int, default=[None])
 
         self.args = parser.parse_args()
     
@@ -53,3 +58,18 @@ class Cli:
     
     def isShowDebug(self):
         return self.args.debug
+    
+    def getJobs(self):
+        return self.args.jobs[0]
+    
+    def isPipelined(self):
+        return self.args.pipeline
+    
+    def isResume(self):
+        return self.args.resume
+    
+    def getBranches(self):
+        return self.args.branch
+    
+    def isWatch(self):
+        return self.args.watch
@@ -40,6 +40,60 @@ class BackupConfig:
         self.common['mount_inplace'] = False
 
         self.table: list[BackupTableRow] = []
+        self.targetIndex: TargetIndex = None
+
+class TargetIndexNode:
+    def __init__(self):
+        self.children = {}
+        self.indices = []
+
+class TargetIndex:
+    def __init__(self, table: list[BackupTableRow]):
+        self.table = table
+        self.branches = {}
+
+        for index, row in enumerate(table):
+            node = self.branches.setdefault(row.branch, TargetIndexNode())
+            for component in self.getPathComponents(row.target):
+                node = node.children.setdefault(component, TargetIndexNode())
+            node.indices.append(index)
+
+    def getPathComponents(self, target):
+        return [p for p in target.split('/') if p != '']
+
+    def __findNode(self, index):
+        node = self.branches[self.table[index].branch]
+        for component in self.getPathComponents(self.table[index].target):
+            node = node.children[component]
+        return node
+
+    def getNestedIndices(self, index):
+        # All rows of the same branch with a target strictly below the target of the given row
+        ret = []
+        stack = list(self.__findNode(index).children.values())
+        while len(stack) > 0:
+            node = stack.pop()
+            ret.extend(node.indices)
+            stack.extend(node.children.values())
+        return sorted(ret)
+
+    def getParentIndices(self, index):
+        # All rows of the same branch with a target strictly above the target of the given row
+        ret = []
+        node = self.branches[self.table[index].branch]
+        for component in self.getPathComponents(self.table[index].target):
+            ret.extend(node.indices)
+            node = node.children[component]
+        return ret
+
+    def getProtectedPaths(self, index):
+        # The targets nested in the given row relative to its target
+        depth = len(self.getPathComponents(self.table[index].target))
+        ret = []
+        for i in self.getNestedIndices(index):
+            components = self.getPathComponents(self.table[i].target)[depth:]
+            ret.append('/' + '/'.join(components))
+        return ret
 
 class BackupConfigParser:
     def __init__(self, configPath = '/etc/bup-backup', debug=False):
@@ -133,16 +187,22 @@ class BackupConfigSorter:
         pass
 
     def sort(self, config: BackupConfig):
-        decoratedTable = [(row.branch,row.target,i,row) for i,row in enumerate(config.table)]
-        decoratedTable.sort()
+        # Sort by the path components, so a parent comes before its nested targets regardless of slashes
+        decoratedTable = [(row.branch,self.__getPathComponents(row.target),i,row) for i,row in enumerate(config.table)]
+        decoratedTable.sort(key=lambda entry: entry[0:3])
         config.table = [row for branch,target,i,row in decoratedTable]
         
         self.__checkDuplicateTargets(decoratedTable)
 
+        config.targetIndex = TargetIndex(config.table)
+
         return config
     
+    def __getPathComponents(self, target):
+        return [p for p in target.split('/') if p != '']
+
     def __checkDuplicateTargets(self, decoratedTable):
-        targets = [(branch,target) for branch,target,i,row in decoratedTable]
+        targets = [(branch,tuple(target)) for branch,target,i,row in decoratedTable]
         seen = set()
         dupes = []
 
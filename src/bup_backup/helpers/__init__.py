@@ -20,4 +20,5 @@ from .command_processing_helper import CommandProcessingHelper
 from .lvm_processing_helper import LVMProcessingHelper
 from .crypt_processing_helper import CryptProcessingHelper
 from .lvm_crypt_processing_helper import LVMCryptProcessingHelper
+from .lvm_raw_processing_helper import LVMRawProcessingHelper
 from .lvm_config_checker import LvmConfigChecker
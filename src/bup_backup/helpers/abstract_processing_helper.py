@@ -29,8 +29,10 @@ class ConfigurationException(Exception):
     pass
 
 class AbstractProcessingHelper:
-    def __init__(self, config: bup_backup.config.BackupConfig, verbose=False, dryRun=False, debug=False):
+    def __init__(self, config: bup_backup.config.BackupConfig, verbose=False, dryRun=False, debug=False, journal=None, snapshotMonitor=None):
         self.config = config
+        self.journal = journal
+        self.snapshotMonitor = snapshotMonitor
 
         self.verbose = verbose
         self.dryRun = dryRun
@@ -38,6 +40,12 @@ class AbstractProcessingHelper:
 
         self.configHelper = ConfigHelper(config)
         self.workdirHelper = Workdir(config)
+        self.bup = None
+    
+    def getBup(self):
+        if self.bup is None:
+            self.bup = bup_backup.bup.Bup(self.config, verbose=self.verbose, dry=self.dryRun, debug=self.debug)
+        return self.bup
 
     def __isCommonConfigurationValid(self, index: int):
         # Is the current user root?
@@ -69,3 +77,7 @@ class AbstractProcessingHelper:
     
     def cleanUpBackup(self, index):
         raise Exception('Not yet implemented.')
+    
+    def cleanUpLeftovers(self, index):
+        # Only helpers that keep resources between the steps need to do anything here.
+        pass
@@ -0,0 +1,44 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import tempfile
+
+def writeJson(path, data, prefix: str, indent=None, folderMode=0o777, sync: bool = False):
+    # Write to a temporary file and move it in place to never leave a partial file
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, mode=folderMode, exist_ok=True)
+
+    fd, tmpName = tempfile.mkstemp(dir=folder, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(data, fp, indent=indent)
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmpName, path)
+    except BaseException:
+        os.unlink(tmpName)
+        raise
+
+    if sync:
+        dirFd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
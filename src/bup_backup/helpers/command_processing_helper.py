@@ -55,6 +55,10 @@ class CommandProcessingHelper(AbstractProcessingHelper):
         if self.debug:
             print('Cmd', cmd)
         
+        if self.workdirHelper.isStreamed(index):
+            self.__streamCommand(index, cmd)
+            return
+        
         workdir = self.workdirHelper.ensureWorkingPathExists(index, self.dryRun, emptyDir=True)
 
         if self.dryRun:
@@ -68,6 +72,32 @@ class CommandProcessingHelper(AbstractProcessingHelper):
                 cwd=workdir,
             ).check_returncode()
 
+    def __streamCommand(self, index, cmd):
+        bup = self.getBup()
+
+        if self.verbose:
+            print(f'Streaming the command output into branch {bup.getSplitName(index)}.')
+        
+        if self.dryRun:
+            print('Executed command', self.config.table[index].source)
+            bup.split(index)
+            return
+        
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+        def waitForCommand(splitInput):
+            returncode = proc.wait()
+            if returncode != 0:
+                raise Exception(f"The command {self.config.table[index].source} terminated with return code {returncode}.")
+        
+        try:
+            bup.split(index, stdin=proc.stdout, producer=waitForCommand)
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
     def cleanUpBackup(self, index):
         # There is nothing to be done here.
         pass
@@ -21,6 +21,7 @@ import re
 class ConfigHelper:
     def __init__(self, config: bup_backup.config.BackupConfig):
         self.config = config
+        self.snapshotHistory = None
 
     def getOption(self, index: int, param: str, fallback = None):
         return self.config.table[index].options.get(param, self.config.common.get(param, fallback))
@@ -28,6 +29,49 @@ class ConfigHelper:
     def getGlobalOption(self, param: str, fallback = None):
         return self.config.common.get(param, fallback)
 
+    def __isTrue(self, value):
+        if isinstance(value, str):
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        return bool(value)
+
+    def getBoolOption(self, index: int, param: str, fallback = False):
+        return self.__isTrue(self.getOption(index, param, fallback))
+
+    def getBoolGlobalOption(self, param: str, fallback = False):
+        return self.__isTrue(self.getGlobalOption(param, fallback))
+
+    def isInPlace(self, index: int):
+        # Raw rows are always streamed from a temporary snapshot
+        if self.config.table[index].type == 'lvm-raw':
+            return False
+        return self.getOption(index, 'mount_inplace', False)
+
+    def isSkippingJournalReplay(self, index: int):
+        value = self.getOption(index, 'mount_skip_replay', 'auto')
+        if value == 'auto':
+            # LVM freezes only file systems directly on the LV. Below dm-crypt, the snapshot is not frozen
+            # and its journal holds committed transactions.
+            return self.config.table[index].type != 'lvm+crypt'
+        return self.__isTrue(value)
+
+    def getSnapType(self, index: int):
+        snapType = self.getOption(index, 'snap_type', 'auto')
+        if snapType == 'auto':
+            # Thin LVs get thin snapshots that need no space reservation in the VG
+            if bup_backup.lvm.Lv().isThin(self.config.table[index].source):
+                return 'thin'
+            return 'cow'
+        return snapType
+
+    def getSnapSize(self, index: int):
+        # Returns the snapshot size as string usable for lvcreate
+        snapSize = self.getOption(index, 'snap_size')
+        if snapSize == 'auto':
+            if self.snapshotHistory is None:
+                self.snapshotHistory = bup_backup.snapshot_history.SnapshotHistory(self.config)
+            return f'{int(self.snapshotHistory.getAutoSize(index) / 1024)}k'
+        return snapSize
+
     def getParsedSize(self, str):
         pattern = '([0-9,.]+)([kKmMgGtT]?)'
         expression = re.compile(pattern)
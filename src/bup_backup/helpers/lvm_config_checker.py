@@ -20,11 +20,14 @@ from .config_helper import ConfigHelper
 from .abstract_processing_helper import ConfigurationException
 
 class LvmConfigChecker:
-    def __init__(self, config: bup_backup.config.BackupConfig):
+    def __init__(self, config: bup_backup.config.BackupConfig, parallelJobs: int = 1):
         self.config = config
         self.configHelper = ConfigHelper(config)
+        self.parallelJobs = max(1, parallelJobs)
         self.neededVgSizes = {}
-        self.neededMaxVgSizes = {}
+        self.neededTempVgSizes = {}
+        self.neededPoolSizes = {}
+        self.vgHeadroom = {}
 
     def __updateRequiredLvSize(self, index):
         def __handleNoLvm(index):
@@ -33,17 +36,31 @@ class LvmConfigChecker:
         lv = bup_backup.lvm.Lv()
 
         def __handleLvm(index: int):
-            vgName = lv.getVgName(self.config.table[index].source)
-            currentSnapSize = self.configHelper.getParsedSize(self.configHelper.getOption(index, 'snap_size'))
+            source = self.config.table[index].source
+            vgName = lv.getVgName(source)
+            currentSnapSize = self.configHelper.getParsedSize(self.configHelper.getSnapSize(index))
 
-            if self.configHelper.getOption(index, 'mount_inplace', False) == True:
-                # There is nothing to account for permanently as data is copied to work folder.
-                # Just the intermediate snapshot is needed
-                maxVgTempSize = max(currentSnapSize, self.neededMaxVgSizes.get(vgName, 0))
-                self.neededMaxVgSizes[vgName] = maxVgTempSize
-            else:
+            snapType = self.configHelper.getSnapType(index)
+            if snapType not in ('thin', 'cow'):
+                raise ConfigurationException(f'The snapshot type {snapType} of {source} is unknown.')
+            if snapType == 'thin':
+                if not lv.isThin(source):
+                    raise ConfigurationException(f'Cannot create a thin snapshot of {source} as it is no thin LV.')
+                
+                # Thin snapshots take no space up front. The snapshot size estimates the blocks
+                # written to the origin during the backup that need new space in the pool.
+                pool = lv.getThinPool(source)
+                self.neededPoolSizes[pool] = self.neededPoolSizes.get(pool, 0) + currentSnapSize
+                return
+
+            if self.configHelper.isInPlace(index) == True:
+                # The snapshot stays mounted until the branch is saved
                 neededVgSize = self.neededVgSizes.get(vgName, 0) + currentSnapSize
                 self.neededVgSizes[vgName] = neededVgSize
+            else:
+                # There is nothing to account for permanently as data is copied to work folder.
+                # Just the intermediate snapshot is needed
+                self.neededTempVgSizes.setdefault(vgName, []).append(currentSnapSize)
 
         
         handlerMapping = {
@@ -52,25 +69,46 @@ class LvmConfigChecker:
             'crypt': __handleNoLvm,
             'lvm': __handleLvm,
             'lvm+crypt': __handleLvm,
+            'lvm-raw': __handleLvm,
         }
 
         # Update the sum and max value
         handlerMapping[self.config.table[index].type](index)
 
+    def getVgHeadroom(self):
+        # The free space in each VG beyond all snapshot reservations
+        return dict(self.vgHeadroom)
+
     def checkFreeSpace(self):
         self.neededVgSizes = {}
-        self.neededMaxVgSizes = {}
+        self.neededTempVgSizes = {}
+        self.neededPoolSizes = {}
 
         for index in range(0, len(self.config.table)):
             self.__updateRequiredLvSize(index)
         
-        # Worst case scenario: The temporary LV is used after all snapshots are already allocated
-        for vgName in self.neededMaxVgSizes.keys():
-            self.neededVgSizes[vgName] = self.neededVgSizes.get(vgName, 0) + self.neededMaxVgSizes[vgName]
+        # Worst case scenario: The largest temporary LVs are used in parallel after all snapshots are already allocated
+        for vgName in self.neededTempVgSizes.keys():
+            tempSizes = sorted(self.neededTempVgSizes[vgName], reverse=True)[0:self.parallelJobs]
+            self.neededVgSizes[vgName] = self.neededVgSizes.get(vgName, 0) + sum(tempSizes)
         
         # Run the checks
         vg = bup_backup.lvm.Vg()
+        self.vgHeadroom = {}
         for vgName in self.neededVgSizes.keys():
             if vg.getFreeSize(vgName) < self.neededVgSizes[vgName]:
                 msg = f'There is not enough free space ({vg.getFreeSize(vgName)/1024.0/1024:1.3f} MB) in the VG {vgName} to hold all snapshots (totally {self.neededVgSizes[vgName]/1024.0/1024:1.3f} MB).'
                 raise ConfigurationException(msg)
+            self.vgHeadroom[vgName] = vg.getFreeSize(vgName) - self.neededVgSizes[vgName]
+        
+        lv = bup_backup.lvm.Lv()
+        maxMetadataPercent = float(self.configHelper.getGlobalOption('thin_max_metadata_percent', 80))
+        for pool in self.neededPoolSizes.keys():
+            freePoolSize = lv.getSize(pool) * (100 - (lv.getDataPercent(pool) or 0)) / 100
+            if freePoolSize < self.neededPoolSizes[pool]:
+                msg = f'There is not enough free space ({freePoolSize/1024.0/1024:1.3f} MB) in the thin pool {pool} to hold the changes during the backup (totally {self.neededPoolSizes[pool]/1024.0/1024:1.3f} MB).'
+                raise ConfigurationException(msg)
+            
+            metadataPercent = lv.getMetadataPercent(pool) or 0
+            if metadataPercent > maxMetadataPercent:
+                raise ConfigurationException(f'The metadata of the thin pool {pool} is {metadataPercent}% full. No snapshots are created above {maxMetadataPercent}%.')
@@ -50,7 +50,8 @@ class LVMCryptProcessingHelper(AbstractProcessingHelper):
             configHelper=self.configHelper,
             dry=self.dryRun,
             verbose=self.verbose,
-            debug=self.debug
+            debug=self.debug,
+            snapshotMonitor=self.snapshotMonitor
         )
         workdir = Workdir(self.config)
         mountHelper = MountHelper(self.config)
@@ -76,7 +77,8 @@ class LVMCryptProcessingHelper(AbstractProcessingHelper):
             workdir=workdir,
             dry=self.dryRun,
             verbose=self.verbose,
-            debug=self.debug
+            debug=self.debug,
+            journal=self.journal
         )
 
     def checkConfig(self, index: int):
@@ -106,7 +108,10 @@ class LVMCryptProcessingHelper(AbstractProcessingHelper):
     
     def prepareBackup(self, index):
         tableLine = self.config.table[index]
-        self.runner.prepareBackup(index, tableLine)
+        return self.runner.prepareBackup(index, tableLine)
     
     def cleanUpBackup(self, index):
         self.runner.cleanUpAfterBackup(index)
+    
+    def cleanUpLeftovers(self, index):
+        self.runner.cleanUpLeftovers(index)
@@ -39,7 +39,8 @@ class LVMProcessingHelper(AbstractProcessingHelper):
             configHelper=self.configHelper,
             dry=self.dryRun,
             verbose=self.verbose,
-            debug=self.debug
+            debug=self.debug,
+            snapshotMonitor=self.snapshotMonitor
         )
         mountMiddleware = MountMiddleware(
             workdir=workdir,
@@ -55,7 +56,8 @@ class LVMProcessingHelper(AbstractProcessingHelper):
             config=self.config,
             configHelper=self.configHelper,
             workdir=workdir,
-            dry=self.dryRun, verbose=self.verbose, debug=self.debug
+            dry=self.dryRun, verbose=self.verbose, debug=self.debug,
+            journal=self.journal
         )
 
     def checkConfig(self, index: int):
@@ -67,14 +69,17 @@ class LVMProcessingHelper(AbstractProcessingHelper):
         if self.vg.hasLv(snapName):
             raise ConfigurationException(f"Cannot create {snapName} as it exists already.")
         
-        snapSizeStr = self.configHelper.getOption(index, 'snap_size')
+        snapSizeStr = self.configHelper.getSnapSize(index)
         snapSize = self.configHelper.getParsedSize(snapSizeStr)
-        if snapSize > self.vg.getFreeSize(vgName):
+        if self.configHelper.getSnapType(index) == 'cow' and snapSize > self.vg.getFreeSize(vgName):
             raise ConfigurationException(f"Not enough free space in VG {vgName} to create snapshot for {tableLine.source}.")
 
     def prepareBackup(self, index):
         tableLine = self.config.table[index]
-        self.runner.prepareBackup(index, tableLine)
+        return self.runner.prepareBackup(index, tableLine)
     
     def cleanUpBackup(self, index):
         self.runner.cleanUpAfterBackup(index)
+    
+    def cleanUpLeftovers(self, index):
+        self.runner.cleanUpLeftovers(index)
@@ -0,0 +1,281 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from .abstract_processing_helper import (
+    AbstractProcessingHelper, ConfigurationException
+)
+
+import bup_backup
+from bup_backup.raw_delta import BlockMap, ThinDelta, RawDeltaStore
+from .workdir import Workdir
+from .middleware import *
+
+import errno
+import fcntl
+import os
+
+class LVMRawProcessingHelper(AbstractProcessingHelper):
+    __F_SETPIPE_SZ = 1031
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vg = bup_backup.lvm.Vg()
+        self.lv = bup_backup.lvm.Lv()
+        self.rawDeltaStore = RawDeltaStore(self.config)
+
+        workdir = Workdir(self.config)
+        self.lvmSnapshotMiddleware = LVMSnapshotMiddleware(
+            config=self.config,
+            configHelper=self.configHelper,
+            dry=self.dryRun,
+            verbose=self.verbose,
+            debug=self.debug,
+            snapshotMonitor=self.snapshotMonitor
+        )
+        self.luksCryptsetupMiddleware = LuksCryptsetupMiddleware(
+            config=self.config,
+            configHelper=self.configHelper,
+            dry=self.dryRun,
+            verbose=self.verbose,
+            debug=self.debug
+        )
+        self.runner = MiddlewareRunner(
+            middlewareList=[self.lvmSnapshotMiddleware],
+            config=self.config,
+            configHelper=self.configHelper,
+            workdir=workdir,
+            dry=self.dryRun, verbose=self.verbose, debug=self.debug,
+            journal=self.journal,
+            transfer=self.__transfer
+        )
+        self.cryptRunner = MiddlewareRunner(
+            middlewareList=[self.lvmSnapshotMiddleware, self.luksCryptsetupMiddleware],
+            config=self.config,
+            configHelper=self.configHelper,
+            workdir=workdir,
+            dry=self.dryRun, verbose=self.verbose, debug=self.debug,
+            journal=self.journal,
+            transfer=self.__streamDevice
+        )
+
+    def __isEncrypted(self, index):
+        return self.configHelper.getOption(index, 'key_file', '') != ''
+
+    def __isDelta(self, index):
+        return self.configHelper.getOption(index, 'raw_mode', 'full') == 'delta'
+
+    def __getRunner(self, index):
+        if self.__isEncrypted(index):
+            return self.cryptRunner
+        return self.runner
+
+    def checkConfig(self, index: int):
+        super().checkConfig(index)
+        tableLine = self.config.table[index]
+        vgName = self.lv.getVgName(tableLine.source)
+
+        snapName = self.lvmSnapshotMiddleware.getFullSnapshotName(index)
+        if self.vg.hasLv(snapName):
+            raise ConfigurationException(f"Cannot create {snapName} as it exists already.")
+        
+        snapSizeStr = self.configHelper.getSnapSize(index)
+        snapSize = self.configHelper.getParsedSize(snapSizeStr)
+        if self.configHelper.getSnapType(index) == 'cow' and snapSize > self.vg.getFreeSize(vgName):
+            raise ConfigurationException(f"Not enough free space in VG {vgName} to create snapshot for {tableLine.source}.")
+        
+        rawMode = self.configHelper.getOption(index, 'raw_mode', 'full')
+        if rawMode not in ('full', 'delta'):
+            raise ConfigurationException(f'Unknown raw mode {rawMode} for {tableLine.source}.')
+        if self.__isDelta(index):
+            if self.__isEncrypted(index):
+                raise ConfigurationException(f'The raw mode delta cannot be combined with a key file for {tableLine.source}.')
+            if self.configHelper.getSnapType(index) != 'thin':
+                raise ConfigurationException(f'The raw mode delta needs a thin LV as source but {tableLine.source} is none.')
+        
+        if self.__isEncrypted(index):
+            keyFile = self.configHelper.getOption(index, 'key_file')
+            if not os.access(keyFile, os.R_OK):
+                raise ConfigurationException(f'The key file {keyFile} cannot be read.')
+            
+            cryptName = self.luksCryptsetupMiddleware.getFullCryptName(index)
+            if os.path.exists(cryptName):
+                raise ConfigurationException(f'The configured crypto device {cryptName} name is already occupied.')
+
+    def __transfer(self, index, device):
+        if self.__isDelta(index):
+            self.__streamDelta(index, device)
+        else:
+            self.__streamDevice(index, device)
+
+    def __copyRange(self, fd, pipe, offset, length, blockSize):
+        pos = offset
+        end = offset + length
+        try:
+            while pos < end:
+                count = os.splice(fd, pipe.fileno(), min(blockSize, end - pos), offset_src=pos)
+                if count == 0:
+                    raise Exception(f'Unexpected end of device at {pos}.')
+                pos += count
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            
+            while pos < end:
+                data = os.pread(fd, min(blockSize, end - pos), pos)
+                if len(data) == 0:
+                    raise Exception(f'Unexpected end of device at {pos}.')
+                pipe.write(data)
+                pos += len(data)
+            pipe.flush()
+
+    def __streamDelta(self, index, device):
+        blockSize = int(self.configHelper.getParsedSize(self.configHelper.getOption(index, 'raw_block_size', '4m')))
+        bup = self.getBup()
+        splitName = bup.getSplitName(index)
+        baseName = self.lvmSnapshotMiddleware.getBaseSnapshotName(index)
+
+        if self.dryRun:
+            print(f'Streaming changed blocks of {device} against {baseName} into bup split {splitName}.')
+            return
+
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+
+            # Only a base that matches the last stored image is a valid reference
+            state = self.rawDeltaStore.load(index)
+            incremental = (
+                state is not None and self.vg.hasLv(baseName) and
+                state['size'] == size and state['dataRef'] == bup.getSplitRef(index) and
+                state['mapRef'] == bup.getSplitRef(index, f'{splitName}.map')
+            )
+
+            if incremental:
+                ranges, zero = ThinDelta(self.config, self.verbose, self.debug).getChanges(
+                    self.lv.getThinPool(device), self.lv.getThinId(baseName), self.lv.getThinId(device), size
+                )
+                blockMap = BlockMap('delta', size, ranges=ranges, zero=zero)
+            else:
+                blockMap = BlockMap('full', size, ranges=[[0, size]])
+            
+            if self.verbose:
+                changed = sum(length for offset, length in blockMap.ranges)
+                print(f'Streaming {len(blockMap.ranges)} ranges ({changed} of {size} bytes) of {device} into bup split.')
+
+            def produce(pipe):
+                try:
+                    fcntl.fcntl(pipe.fileno(), self.__F_SETPIPE_SZ, min(blockSize, 1024*1024))
+                except OSError:
+                    pass
+                for offset, length in blockMap.ranges:
+                    self.__copyRange(fd, pipe, offset, length, blockSize)
+
+            bup.split(index, producer=produce)
+        finally:
+            os.close(fd)
+        
+        blockMap.data = bup.getSplitRef(index)
+        mapData = blockMap.toJson().encode()
+        bup.split(index, producer=lambda pipe: pipe.write(mapData), name=f'{splitName}.map')
+
+        # The state is written last. Any interruption before leads to a full run next time.
+        self.__moveBase(index, device)
+        self.rawDeltaStore.store(index, {
+            'size': size,
+            'dataRef': blockMap.data,
+            'mapRef': bup.getSplitRef(index, f'{splitName}.map'),
+        })
+
+    def __moveBase(self, index, device):
+        # Keep the current snapshot as reference for the next run
+        baseName = self.lvmSnapshotMiddleware.getBaseSnapshotName(index)
+        nextName = f'{baseName}-next'
+
+        if self.vg.hasLv(nextName):
+            self.lv.removeSnapshot(nextName, dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+        self.lv.createSnapshot(
+            name=device, snapName=os.path.basename(nextName), size=None,
+            dry=self.dryRun, verbose=self.verbose, debug=self.debug,
+            thin=True
+        )
+        self.__finishBaseRename(index)
+
+    def __finishBaseRename(self, index):
+        baseName = self.lvmSnapshotMiddleware.getBaseSnapshotName(index)
+        nextName = f'{baseName}-next'
+
+        if not self.vg.hasLv(nextName):
+            return
+        if self.vg.hasLv(baseName):
+            self.lv.removeSnapshot(baseName, dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+        self.lv.rename(nextName, os.path.basename(baseName), dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+
+    def __streamDevice(self, index, device):
+        blockSize = int(self.configHelper.getParsedSize(self.configHelper.getOption(index, 'raw_block_size', '4m')))
+
+        if self.verbose:
+            print(f'Streaming block device {device} into bup split.')
+
+        def produce(pipe):
+            fd = os.open(device, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                
+                try:
+                    # A larger pipe allows to move bigger blocks at once
+                    fcntl.fcntl(pipe.fileno(), self.__F_SETPIPE_SZ, min(blockSize, 1024*1024))
+                except OSError:
+                    pass
+                
+                try:
+                    # Move the data within the kernel without copying it through user space
+                    while os.splice(fd, pipe.fileno(), blockSize) > 0:
+                        pass
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    
+                    # Not all devices support splice. Continue from the current position.
+                    while True:
+                        data = os.read(fd, blockSize)
+                        if len(data) == 0:
+                            break
+                        pipe.write(data)
+                    pipe.flush()
+            finally:
+                os.close(fd)
+
+        self.getBup().split(index, producer=produce)
+
+    def prepareBackup(self, index):
+        tableLine = self.config.table[index]
+        self.__getRunner(index).prepareBackup(index, tableLine)
+    
+    def cleanUpBackup(self, index):
+        # The snapshot is removed directly after streaming.
+        pass
+
+    def cleanUpLeftovers(self, index):
+        self.__getRunner(index).cleanUpLeftovers(index)
+        if self.__isDelta(index):
+            # An interrupted run might have created the new base without renaming it
+            self.__finishBaseRename(index)
+
+            source = self.config.table[index].source
+            if self.lv.isThin(source):
+                ThinDelta(self.config, self.verbose, self.debug).releaseMetadataSnapshot(self.lv.getThinPool(source), dry=self.dryRun)
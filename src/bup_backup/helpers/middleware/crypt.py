@@ -19,9 +19,14 @@ import bup_backup
 from ..config_helper import ConfigHelper
 
 import hashlib
+import os
+import stat
 import subprocess
+import threading
 
 class LuksCryptsetupMiddleware:
+    __cacheLock = threading.Lock()
+
     def __init__(
         self,
         config: bup_backup.config.BackupConfig,
@@ -46,28 +51,116 @@ class LuksCryptsetupMiddleware:
         cryptName = self.__getCryptDeviceName(index)
         return f'/dev/mapper/{cryptName}'
     
+    def __isReadOnly(self, index):
+        # A journal replay while mounting needs a writable device
+        readOnly = self.configHelper.getOption(index, 'crypt_readonly', 'auto')
+        if readOnly == 'auto':
+            if self.config.table[index].type == 'lvm-raw':
+                return True
+            return self.configHelper.getOption(index, 'mount_options') is None and self.configHelper.isSkippingJournalReplay(index)
+        return self.configHelper.getBoolOption(index, 'crypt_readonly')
+
+    def __getOpenOptions(self, index):
+        ret = []
+        if self.__isReadOnly(index):
+            ret.append('--readonly')
+        if self.configHelper.getBoolOption(index, 'crypt_no_read_workqueue'):
+            ret.append('--perf-no_read_workqueue')
+        if self.configHelper.getBoolOption(index, 'crypt_no_write_workqueue'):
+            ret.append('--perf-no_write_workqueue')
+        return ret
+
+    def __getCacheDir(self):
+        cacheDir = self.configHelper.getGlobalOption('luks_key_cache_dir', '/var/lib/bup-backup/luks-keys')
+        os.makedirs(cacheDir, mode=0o700, exist_ok=True)
+
+        # The volume keys must only be accessible by root
+        st = os.stat(cacheDir)
+        if st.st_uid != 0 or stat.S_IMODE(st.st_mode) & 0o077 != 0:
+            raise Exception(f'The key cache {cacheDir} must be owned by root and not accessible by others.')
+        return cacheDir
+
+    def __getLuksUuid(self, source):
+        cmd = ['cryptsetup', 'luksUUID', source]
+        if self.debug:
+            print('UUID command', cmd)
+        return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout.strip()
+
+    def __getCachedKey(self, index, source):
+        # Returns the file of the volume key. The expensive key derivation runs only once per LUKS device.
+        keyFile = self.configHelper.getOption(index, 'key_file')
+        cacheFile = os.path.join(self.__getCacheDir(), f'{self.__getLuksUuid(source)}.key')
+
+        with self.__cacheLock:
+            if os.path.exists(cacheFile):
+                return cacheFile
+            
+            if self.verbose:
+                print(f'Deriving the volume key of {source} for the key cache.')
+            
+            # cryptsetup refuses to overwrite existing files
+            tmpFile = f'{cacheFile}.tmp-{os.getpid()}'
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            
+            cmd = [
+                'cryptsetup', 'luksDump',
+                '--batch-mode',
+                '--dump-volume-key',
+                '--volume-key-file', tmpFile,
+                '-d', keyFile,
+                source
+            ]
+            if self.debug:
+                print('Key derivation command', cmd)
+            
+            try:
+                subprocess.run(cmd, stdout=subprocess.DEVNULL).check_returncode()
+                os.chmod(tmpFile, 0o400)
+                os.replace(tmpFile, cacheFile)
+            finally:
+                if os.path.exists(tmpFile):
+                    os.remove(tmpFile)
+        
+        return cacheFile
+
+    def __open(self, index, source, cryptName, keyOptions):
+        cmd = ['cryptsetup', 'open'] + keyOptions + self.__getOpenOptions(index) + [source, cryptName]
+
+        if self.debug:
+            print('Decryption command', cmd)
+        
+        return subprocess.run(cmd).returncode
+
     def beforeStep(self, index, source, inPlace, state):
         cryptName = self.__getCryptDeviceName(index)
         fullCryptName = self.getFullCryptName(index)
         keyFile = self.configHelper.getOption(index, 'key_file')
+        useCache = self.configHelper.getBoolOption(index, 'luks_key_cache')
 
         if self.verbose:
             print(f'Decrypting {source} in middleware.')
         
-        cmd = [
-            'cryptsetup', 'open', 
-            '-d', keyFile,
-            source,
-            cryptName
-        ]
-
-        if self.debug:
-            print('Decryption command', cmd)
-        
         if self.dry:
-            print(f'Carrying out decryption of {source} to {cryptName}.')
-        else:
-            subprocess.run(cmd).check_returncode()
+            if useCache:
+                print(f'Using the cached volume key of {source}.')
+            print(f'Carrying out decryption of {source} to {cryptName} with options {self.__getOpenOptions(index)}.')
+            return (fullCryptName, cryptName)
+        
+        cacheFile = None
+        if useCache:
+            cacheFile = self.__getCachedKey(index, source)
+            if self.__open(index, source, cryptName, ['--volume-key-file', cacheFile]) == 0:
+                return (fullCryptName, cryptName)
+            print(f'Warning: The cached volume key of {source} could not be used. Trying the key file.')
+        
+        if self.__open(index, source, cryptName, ['-d', keyFile]) != 0:
+            raise Exception(f'Cannot open the LUKS device {source}.')
+        
+        if cacheFile is not None:
+            # The device opens with the key file only, so the volume key changed (e.g. by a reencryption)
+            print(f'Removing the outdated cached volume key of {source}.')
+            os.remove(cacheFile)
         
         return (fullCryptName, cryptName)
 
@@ -27,10 +27,12 @@ class LVMSnapshotMiddleware(Middleware):
         self,
         config: bup_backup.config.BackupConfig,
         configHelper: ConfigHelper,
-        dry, verbose, debug
+        dry, verbose, debug,
+        snapshotMonitor = None
     ):
         self.config = config
         self.configHelper = configHelper
+        self.snapshotMonitor = snapshotMonitor
 
         self.dry = dry
         self.verbose = verbose
@@ -44,7 +46,9 @@ class LVMSnapshotMiddleware(Middleware):
         return snapName
     
     def __getSnapNameTemporarySnapshot(self, index, snapNameBase):
-        snapName = f'{snapNameBase}---tmp'
+        # Each row gets its own name to allow multiple rows to be prepared in parallel
+        dynPart = f'{self.config.table[index].branch}:{self.config.table[index].target}'
+        snapName = f'{snapNameBase}---tmp-{hashlib.md5(dynPart.encode()).hexdigest()}'
         return snapName
         
     def __getSnapName(self, index, runInplace):
@@ -55,8 +59,15 @@ class LVMSnapshotMiddleware(Middleware):
         else:
             return self.__getSnapNameTemporarySnapshot(index, snapNameBase)
         
+    def getBaseSnapshotName(self, index):
+        # The snapshot kept until the next run as reference for changed-block backups
+        snapNameBase = self.configHelper.getOption(index, 'snap_name')
+        dynPart = f'{self.config.table[index].branch}:{self.config.table[index].target}'
+        vgName = self.lv.getVgName(self.config.table[index].source)
+        return f'/dev/{vgName}/{snapNameBase}---base-{hashlib.md5(dynPart.encode()).hexdigest()}'
+
     def getFullSnapshotName(self, index):
-        inPlace = self.configHelper.getOption(index, 'mount_inplace', False)
+        inPlace = self.configHelper.isInPlace(index)
         lv = bup_backup.lvm.Lv()
         vgName = lv.getVgName(self.config.table[index].source)
         return f'/dev/{vgName}/{self.__getSnapName(index, inPlace)}'
@@ -66,7 +77,8 @@ class LVMSnapshotMiddleware(Middleware):
 
     def beforeStep(self, index, source, inPlace, state):
         snapName = self.__getSnapName(index, inPlace)
-        size = self.configHelper.getOption(index, 'snap_size')
+        size = self.configHelper.getSnapSize(index)
+        thin = self.configHelper.getSnapType(index) == 'thin'
 
         if self.verbose:
             print(f'Create snapshot {snapName} using middleware.')
@@ -74,13 +86,21 @@ class LVMSnapshotMiddleware(Middleware):
         fullSnapName = self.lv.createSnapshot(
             name=source, snapName=snapName,
             size=size,
-            dry=self.dry, verbose=self.verbose, debug=self.debug
+            dry=self.dry, verbose=self.verbose, debug=self.debug,
+            thin=thin
             )
         
+        if self.snapshotMonitor is not None and not thin:
+            # Thin snapshots cannot run full
+            self.snapshotMonitor.register(index, fullSnapName)
+
         return (fullSnapName, None)
 
     def afterStep(self, dest, state):
         if self.verbose:
             print(f'Removing snapshot {dest} using middleware.')
         
+        if self.snapshotMonitor is not None:
+            self.snapshotMonitor.unregister(dest)
+
         self.lv.removeSnapshot(dest, dry=self.dry, verbose=self.verbose, debug=self.debug)
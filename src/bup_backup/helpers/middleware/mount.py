@@ -45,14 +45,19 @@ class MountMiddleware(Middleware):
         return None
 
     def beforeStep(self, index, source, inPlace, state):
-        workpath = self.workdir.ensureWorkingPathExists(index, dry=self.dry, emptyDir=self.emptyDir)
-
-        if inPlace:
-            mountPath = workpath
-        else:
+        grafted = inPlace and self.workdir.isGrafted(index)
+        if grafted:
+            # The mounted data is saved directly from the mount point
             mountPath = self.mountHelper.getMountPoint(index)
+        else:
+            workpath = self.workdir.ensureWorkingPathExists(index, dry=self.dry, emptyDir=self.emptyDir)
+
+            if inPlace:
+                mountPath = workpath
+            else:
+                mountPath = self.mountHelper.getMountPoint(index)
         
-        if self.createDir:
+        if self.createDir or grafted:
             if self.dry:
                 print(f'Ensuring that mount path {mountPath} exists.')
             else:
@@ -60,7 +65,8 @@ class MountMiddleware(Middleware):
 
         if self.verbose:
             print('Mounting using mount middleware')
-        self.mountHelper.mount(source, mountPath, dry=self.dry, verbose=self.verbose, debug=self.debug)
+        options = self.mountHelper.getMountOptions(index, source, debug=self.debug)
+        self.mountHelper.mount(source, mountPath, dry=self.dry, verbose=self.verbose, debug=self.debug, options=options)
 
         return (mountPath, state)
 
@@ -19,10 +19,9 @@ import bup_backup
 from ..config_helper import ConfigHelper
 from ..workdir import Workdir
 from ..rsync_helper import RSyncHelper
+from ..reflink_helper import ReflinkHelper
 from .middleware import Middleware
 
-import re
-
 class MiddlewareRunner:
     def __init__(
         self,
@@ -30,7 +29,9 @@ class MiddlewareRunner:
         config: bup_backup.config.BackupConfig,
         configHelper: ConfigHelper,
         workdir: Workdir,
-        dry, verbose, debug
+        dry, verbose, debug,
+        journal = None,
+        transfer = None
     ):
         self.middlewareList = middlewareList
         self.configHelper = configHelper
@@ -41,8 +42,16 @@ class MiddlewareRunner:
         self.verbose = verbose
         self.debug = debug
 
+        self.journal = journal
+        self.transfer = transfer
         self.states = {}
         self.rsync = RSyncHelper(self.config)
+        self.reflink = ReflinkHelper(self.config)
+
+    def __getStager(self, index):
+        if self.configHelper.getOption(index, 'staging', 'rsync') == 'reflink':
+            return self.reflink
+        return self.rsync
 
     def __prepareStateStructure(self, index):
         if index not in self.states.keys():
@@ -50,7 +59,7 @@ class MiddlewareRunner:
             self.states[index] = [None for x in self.middlewareList]
 
     def __isRunningInPlace(self, index):
-        return self.configHelper.getOption(index, 'mount_inplace')
+        return self.configHelper.isInPlace(index)
 
     def prepareBackup(self, index, tableLine: bup_backup.config.BackupTableRow):
         self.__prepareStateStructure(index)
@@ -76,10 +85,19 @@ class MiddlewareRunner:
             (dest, newState) = middleware.beforeStep(index, source, inPlace, state)
 
             self.states[index][i] = (dest, newState)
+            self.__journalSteps(index, i + 1)
         
         # All preparation steps have been done.
 
-        if not inPlace:
+        if not inPlace and self.transfer is not None:
+            # The data is not synchronized to the work folder but handled by the given transfer function
+            self.transfer(index, self.states[index][-1][0])
+
+            if self.verbose:
+                print('Data is transferred. Closing temporary steps.')
+            
+            self.__cleanUpMiddlewares(index)
+        elif not inPlace:
             # First, the sync to the work folder need to be carried out
             lastStoredLocation = self.states[index][-1][0]
             dest = self.workdir.getWorkingPath(index)
@@ -87,21 +105,9 @@ class MiddlewareRunner:
             if self.verbose:
                 print('Copying data from temporary location to final workdir')
 
-            currentTarget = tableLine.target
-            while currentTarget.endswith('/'):
-                currentTarget = currentTarget[0:-1]
-            regex = re.compile(f'{currentTarget}(/.+)')
-
-            protectedPaths = []
-            for line in self.config.table:
-                if line.branch != tableLine.branch:
-                    continue
-                match = regex.match(line.target)
-                if match is not None:
-                    protectedPaths.append(match.group(1))
-                
-
-            self.rsync.execute(
+            protectedPaths = self.config.targetIndex.getProtectedPaths(index)
+
+            result = self.__getStager(index).execute(
                 index=index,
                 source=lastStoredLocation,
                 dest=dest,
@@ -115,14 +121,43 @@ class MiddlewareRunner:
             # We need to run the closing steps of the middlewares in revered order
             self.__cleanUpMiddlewares(index)
 
-    def __cleanUpMiddlewares(self, index):
-        indexRange = range(len(self.middlewareList))
-        for i in reversed(indexRange):
+            return result
+
+    def __journalSteps(self, index, numSteps):
+        if self.journal is not None:
+            self.journal.setMiddlewareSteps(index, self.states[index][0:numSteps])
+
+    def __cleanUpMiddlewares(self, index, numSteps = None):
+        if numSteps is None:
+            numSteps = len(self.middlewareList)
+        
+        for i in reversed(range(numSteps)):
             middleware: Middleware
             middleware = self.middlewareList[i]
 
             (dest, state) = self.states[index][i]
             middleware.afterStep(dest=dest, state=state)
+            self.__journalSteps(index, i)
+    
+    def cleanUpLeftovers(self, index):
+        if self.journal is None:
+            return
+        
+        steps = self.journal.getMiddlewareSteps(index)
+        if len(steps) == 0:
+            return
+        
+        if self.verbose:
+            print(f'Removing leftovers of a previous run for {self.config.table[index].source}.')
+        
+        self.__prepareStateStructure(index)
+        for i in range(len(steps)):
+            self.states[index][i] = steps[i]
+        
+        self.__cleanUpMiddlewares(index, len(steps))
+
+        # Any in-place data is gone now, so the row has to be prepared again
+        self.journal.setRowPrepared(index, False)
 
     def cleanUpAfterBackup(self, index):
         if self.__isRunningInPlace(index):
@@ -23,6 +23,25 @@ import subprocess
 import hashlib
 
 class MountHelper:
+    __PROFILES = {
+        'ext2': 'ro,noatime',
+        'ext3': 'ro,noatime',
+        'ext4': 'ro,noatime',
+        'xfs': 'ro,nouuid,noatime',
+        'btrfs': 'ro,noatime',
+        'f2fs': 'ro,noatime',
+    }
+    # Options to mount a frozen snapshot without journal replay, which would be slow and write into the snapshot
+    __NO_REPLAY = {
+        'ext3': 'noload',
+        'ext4': 'noload',
+        'xfs': 'norecovery',
+        'btrfs': 'nologreplay',
+        'f2fs': 'norecovery',
+    }
+    __EXT_SUPERBLOCK = 1024
+    __EXT_MAGIC = 0xEF53
+    __EXT_INCOMPAT_RECOVER = 0x4
     
     def __init__(self, config: bup_backup.config.BackupConfig):
         self.config = config
@@ -34,6 +53,50 @@ class MountHelper:
         basedPath = os.path.join(base, hashlib.md5(tableLine.source.encode()).hexdigest())
         return self.configHelper.getOption(index, 'mount_path', basedPath)
     
+    def getFsType(self, device, debug):
+        cmd = ['blkid', '-p', '-s', 'TYPE', '-o', 'value', device]
+        if debug:
+            print('blkid command', cmd)
+        
+        sp = subprocess.run(cmd, capture_output=True, text=True)
+        if sp.returncode != 0:
+            return None
+        return sp.stdout.strip()
+
+    def __parseOptions(self, options):
+        # Table options are separated by commas, so mount options in the table use + instead
+        return [o for o in options.replace('+', ',').split(',') if o != '']
+
+    def __needsExtRecovery(self, device):
+        try:
+            with open(device, 'rb') as fp:
+                fp.seek(self.__EXT_SUPERBLOCK)
+                superblock = fp.read(0x64)
+        except OSError:
+            return False
+        if len(superblock) < 0x64 or int.from_bytes(superblock[0x38:0x3a], 'little') != self.__EXT_MAGIC:
+            return False
+        return int.from_bytes(superblock[0x60:0x64], 'little') & self.__EXT_INCOMPAT_RECOVER != 0
+
+    def getMountOptions(self, index, device, debug):
+        options = self.configHelper.getOption(index, 'mount_options')
+        if options is None:
+            fsType = self.getFsType(device, debug)
+            options = self.__PROFILES.get(fsType, 'ro')
+            if debug:
+                print(f'Detected file system {fsType} on {device}.')
+            
+            if self.configHelper.isSkippingJournalReplay(index) and fsType in self.__NO_REPLAY:
+                options = f'{options},{self.__NO_REPLAY[fsType]}'
+                if fsType in ('ext3', 'ext4') and self.__needsExtRecovery(device):
+                    print(f'Warning: The journal of {device} needs recovery but is not replayed. Its committed transactions are missing in the backup. Set mount_skip_replay = no to replay it.')
+        
+        ret = self.__parseOptions(options)
+        for o in self.__parseOptions(self.configHelper.getOption(index, 'mount_options_extra', '')):
+            if o not in ret:
+                ret.append(o)
+        return ','.join(ret)
+
     def mount(self, device, location, dry, verbose, debug, options = 'ro'):
         if verbose:
             print(f'Mounting {device} at {location} (options {options}).')
@@ -51,6 +114,25 @@ class MountHelper:
         else:
             subprocess.run(cmd).check_returncode()
     
+    def bindMount(self, source, location, dry, verbose, debug):
+        if verbose:
+            print(f'Bind mounting {source} read-only at {location}.')
+        
+        # Older versions of mount ignore ro for bind mounts, so remount explicitly
+        cmds = [
+            ['mount', '--bind', source, location],
+            ['mount', '-o', 'remount,bind,ro', location],
+        ]
+
+        for cmd in cmds:
+            if debug:
+                print('Mount command', cmd)
+            
+            if dry:
+                print(f"Bind mounting {source}")
+            else:
+                subprocess.run(cmd).check_returncode()
+    
     def umount(self, location, dry, verbose, debug):
         if verbose:
             print(f'Unmounting {location}.')
@@ -15,18 +15,27 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import bup_backup
+
 from .abstract_processing_helper import (
     AbstractProcessingHelper, ConfigurationException
 )
 from .rsync_helper import RSyncHelper
+from .reflink_helper import ReflinkHelper
+from .tree_fingerprint import TreeFingerprint
+from .mount_helper import MountHelper
 
 import os
-import re
+import hashlib
 
 class PlainProcessingHelper(AbstractProcessingHelper):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.rsync = RSyncHelper(self.config)
+        self.reflink = ReflinkHelper(self.config)
+        self.fingerprint = TreeFingerprint(self.config)
+        self.mountHelper = MountHelper(self.config)
+        self.dirtyStore = bup_backup.watcher.DirtyStore(self.config)
     
     def checkConfig(self, index: int):
         super().checkConfig(index)
@@ -35,35 +44,167 @@ class PlainProcessingHelper(AbstractProcessingHelper):
         if not os.path.isdir(tableLine.source):
             raise ConfigurationException(f"Path {tableLine.source} is no folder.")
         
-        self.rsync.check()
+        if self.__isBindMounted(index):
+            self.__checkBindMount(index)
+        else:
+            self.__getStager(index).check()
     
+    def __getStager(self, index):
+        if self.configHelper.getOption(index, 'staging', 'rsync') == 'reflink':
+            return self.reflink
+        return self.rsync
+
+    def __isBindMounted(self, index):
+        return self.configHelper.getOption(index, 'staging', 'rsync') == 'bind'
+
+    def __checkBindMount(self, index):
+        tableLine = self.config.table[index]
+        targetIndex = self.config.targetIndex
+        depth = len(targetIndex.getPathComponents(tableLine.target))
+
+        # Another bind mount would be stacked on top of the stale one
+        workDir = self.workdirHelper.getWorkingPath(index)
+        if os.path.ismount(workDir):
+            raise ConfigurationException(f"The work folder {workDir} of {tableLine.source} is still mounted by a previous run. Unmount it or run with --resume.")
+
+        for i in targetIndex.getNestedIndices(index):
+            line = self.config.table[i]
+
+            # Nested targets are stacked on top of the read-only bind mount.
+            # So they must not write and their mount point must exist.
+            nestedPlain = line.type == 'plain' and self.configHelper.getOption(i, 'staging', 'rsync') == 'bind'
+            nestedMount = line.type in ('lvm', 'lvm+crypt') and self.configHelper.isInPlace(i)
+            if not nestedPlain and not nestedMount:
+                raise ConfigurationException(f"The target {line.target} is nested in the bind mounted target {tableLine.target}. It needs to be bind mounted or mounted in place as well.")
+            
+            mountPoint = os.path.join(tableLine.source, *targetIndex.getPathComponents(line.target)[depth:])
+            if not os.path.isdir(mountPoint):
+                raise ConfigurationException(f"The nested target {line.target} cannot be mounted into the bind mount of {tableLine.source} as {mountPoint} is no folder.")
+
     def prepareBackup(self, index):
+        if self.workdirHelper.isGrafted(index):
+            if self.verbose:
+                print(f'No staging needed for {self.config.table[index].source} as it is grafted directly.')
+            return
+        
+        if self.__isBindMounted(index):
+            workDir = self.workdirHelper.ensureWorkingPathExists(index, self.dryRun)
+            self.mountHelper.bindMount(self.config.table[index].source, workDir, dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+            return
+        
         workDir = self.workdirHelper.ensureWorkingPathExists(index, self.dryRun)
 
-        currentTarget = self.config.table[index].target
-        while currentTarget.endswith('/'):
-            currentTarget = currentTarget[0:-1]
-        regex = re.compile(f'{currentTarget}(/.+)')
-
-        protectedPaths = []
-        for line in self.config.table:
-            if line.branch != self.config.table[index].branch:
-                continue
-            match = regex.match(line.target)
-            if match is not None:
-                protectedPaths.append(match.group(1))
+        protectedPaths = self.config.targetIndex.getProtectedPaths(index)
+
+        if self.__isWatched(index):
+            return self.__syncWatched(index, workDir, protectedPaths)
+        
+        useFingerprint = self.configHelper.getBoolOption(index, 'fingerprint')
+        subPaths = None
+        if useFingerprint:
+            fingerprint = self.__getFingerprint(index, workDir, protectedPaths)
+            subPaths = self.fingerprint.getChangedSubtrees(self.fingerprint.load(index), fingerprint)
+            if subPaths is not None:
+                # Nested targets are hidden from the transfer anyway
+                subPaths = [p for p in subPaths if f'/{p}' not in protectedPaths]
+
+            if subPaths is not None and len(subPaths) == 0:
+                if self.verbose:
+                    print(f'The fingerprint of {self.config.table[index].source} is unchanged. Skipping rsync.')
+                return
+            if self.verbose and subPaths is not None:
+                print('Only synchronizing changed sub trees', subPaths)
         
         if self.verbose:
             print('Cloning files from plain folder')
         
-        self.rsync.execute(
+        result = self.__getStager(index).execute(
             index, 
             self.config.table[index].source, 
             workDir, 
             verbose=self.verbose, dry=self.dryRun, debug=self.debug,
-            protectedDirs=protectedPaths
+            protectedDirs=protectedPaths,
+            subPaths=subPaths
         )
 
+        if useFingerprint and not self.dryRun:
+            self.fingerprint.store(index, fingerprint)
+
+        return result
+
+    def __isWatched(self, index):
+        return self.configHelper.getBoolOption(index, 'watch') and self.__getStager(index) is self.rsync
+
+    def __syncWatched(self, index, workDir, protectedPaths):
+        token = hashlib.sha256('\0'.join(self.__getSyncParams(index, workDir, protectedPaths)).encode()).hexdigest()
+        if self.dryRun:
+            taken = self.dirtyStore.load(index)
+            usable = self.dirtyStore.isUsable(index, taken, token)
+        else:
+            taken, usable = self.dirtyStore.take(index, token)
+        
+        dirty = None
+        if usable:
+            dirty = (taken['dirs'], taken['trees'])
+            if len(taken['dirs']) == 0 and len(taken['trees']) == 0:
+                if self.verbose:
+                    print(f'The watcher found no changes in {self.config.table[index].source}. Skipping rsync.')
+                return
+            if self.verbose:
+                print(f"Only synchronizing {len(taken['dirs'])} changed folders and {len(taken['trees'])} new trees reported by the watcher.")
+        elif self.verbose:
+            print(f'There is no complete list of changes of {self.config.table[index].source} from the watcher. Synchronizing the whole tree.')
+
+        try:
+            return self.rsync.execute(
+                index,
+                self.config.table[index].source,
+                workDir,
+                verbose=self.verbose, dry=self.dryRun, debug=self.debug,
+                protectedDirs=protectedPaths,
+                dirty=dirty
+            )
+        except BaseException:
+            if not self.dryRun:
+                self.dirtyStore.restore(index, taken)
+            raise
+
+    def __getSyncParams(self, index, workDir, protectedPaths):
+        # Any change of the sync parameters or of the work folder invalidates the stored state
+        params = self.__getStager(index).getOptions(index) + sorted(protectedPaths)
+        if os.path.exists(workDir):
+            workDirStat = os.stat(workDir)
+            params.append(f'{workDirStat.st_dev}:{workDirStat.st_ino}')
+        else:
+            params.append('')
+        return params
+
+    def __getFingerprint(self, index, workDir, protectedPaths):
+        if self.verbose:
+            print(f'Calculating fingerprint of {self.config.table[index].source}.')
+        
+        fingerprint = self.fingerprint.scan(index, self.config.table[index].source)
+
+        params = self.__getSyncParams(index, workDir, protectedPaths)
+        if fingerprint['root'] is not None:
+            params.append(fingerprint['root'])
+            fingerprint['root'] = hashlib.sha256('\0'.join(params).encode()).hexdigest()
+
+        return fingerprint
+
     def cleanUpBackup(self, index):
-        # We do not need to clean anything up here.
-        pass
+        if self.__isBindMounted(index):
+            self.mountHelper.umount(self.workdirHelper.getWorkingPath(index), dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+    
+    def cleanUpLeftovers(self, index):
+        if not self.__isBindMounted(index):
+            return
+        
+        workDir = self.workdirHelper.getWorkingPath(index)
+        if os.path.ismount(workDir):
+            if self.verbose:
+                print(f'Removing bind mount {workDir} of a previous run.')
+            self.mountHelper.umount(workDir, dry=self.dryRun, verbose=self.verbose, debug=self.debug)
+        
+        if self.journal is not None:
+            self.journal.setRowPrepared(index, False)
@@ -0,0 +1,309 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bup_backup
+
+from .abstract_processing_helper import (
+    ConfigurationException
+)
+from .rsync_helper import RSyncResult
+
+import errno
+import fcntl
+import os
+import stat
+import sys
+import tempfile
+import time
+
+class ReflinkTransfer:
+    # ioctl number of FICLONE from linux/fs.h
+    FICLONE = 0x40049409
+    __FALLBACK_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EPERM)
+    __CHUNK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, copyModes: dict, protectedDirs: list[str], verbose: bool, dry: bool):
+        self.copyModes = copyModes
+        self.protected = set(self.__normalize(p) for p in protectedDirs)
+        self.verbose = verbose
+        self.dry = dry
+        self.isRoot = os.geteuid() == 0
+
+        self.result = RSyncResult()
+        self.result.runs = 1
+        for regex, name in RSyncResult.STATS:
+            if not name.startswith('bytes'):
+                setattr(self.result, name, 0)
+
+    def __normalize(self, path):
+        return '/' + '/'.join(p for p in path.split('/') if p != '')
+
+    def __log(self, message):
+        if self.verbose:
+            print(message)
+
+    def __lstat(self, path):
+        try:
+            return os.lstat(path)
+        except FileNotFoundError:
+            return None
+
+    def run(self, source, dest, subPaths=None):
+        srcStat = os.stat(source)
+        self.srcDevice = srcStat.st_dev
+        destStat = self.__lstat(dest)
+        self.destDevice = destStat.st_dev if destStat is not None else None
+
+        if subPaths is None:
+            self.__syncDir(source, dest, '')
+            self.__applyMeta(dest, srcStat)
+        else:
+            for name in subPaths:
+                rel = f'/{name}'
+                if rel in self.protected:
+                    continue
+                st = os.lstat(os.path.join(source, name))
+                self.__syncEntry(os.path.join(source, name), os.path.join(dest, name), rel, st)
+
+        return self.result
+
+    def __syncDir(self, source, dest, rel):
+        with os.scandir(source) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        names = set()
+        for entry in entries:
+            entryRel = f'{rel}/{entry.name}'
+            if entryRel in self.protected:
+                # Hidden from the transfer like rsync -fH
+                continue
+            names.add(entry.name)
+            self.__syncEntry(entry.path, os.path.join(dest, entry.name), entryRel, entry.stat(follow_symlinks=False))
+
+        if not os.path.isdir(dest):
+            return
+
+        # Same as rsync --delete
+        with os.scandir(dest) as it:
+            obsolete = sorted((e for e in it if e.name not in names), key=lambda e: e.name)
+        for entry in obsolete:
+            self.__remove(entry.path, f'{rel}/{entry.name}')
+
+    def __syncEntry(self, source, dest, rel, st):
+        self.result.files += 1
+        destStat = self.__lstat(dest)
+
+        if destStat is not None and stat.S_IFMT(destStat.st_mode) != stat.S_IFMT(st.st_mode):
+            self.__remove(dest, rel)
+            destStat = self.__lstat(dest)
+            if destStat is not None:
+                raise Exception(f'Cannot replace {dest} as it contains protected or foreign content.')
+
+        if stat.S_ISDIR(st.st_mode):
+            if destStat is None:
+                self.__log(f'{rel[1:]}/')
+                self.result.createdFiles += 1
+                if not self.dry:
+                    os.mkdir(dest, 0o700)
+            # Like rsync -x, other file systems are not entered. Only the mount point is created.
+            if st.st_dev == self.srcDevice:
+                self.__syncDir(source, dest, rel)
+            self.__applyMeta(dest, st)
+        elif stat.S_ISREG(st.st_mode):
+            self.result.totalSize += st.st_size
+            if destStat is not None and destStat.st_size == st.st_size and destStat.st_mtime_ns == st.st_mtime_ns:
+                self.__applyMeta(dest, st, destStat)
+                return
+            self.__log(rel[1:])
+            if destStat is None:
+                self.result.createdFiles += 1
+            self.result.transferredFiles += 1
+            self.result.transferredSize += st.st_size
+            if not self.dry:
+                self.__copyFile(source, dest, st)
+        elif stat.S_ISLNK(st.st_mode):
+            linkTarget = os.readlink(source)
+            if destStat is not None and os.readlink(dest) == linkTarget:
+                self.__applyMeta(dest, st, destStat)
+                return
+            self.__log(f'{rel[1:]} -> {linkTarget}')
+            if destStat is None:
+                self.result.createdFiles += 1
+            if self.dry:
+                return
+            if destStat is not None:
+                os.unlink(dest)
+            os.symlink(linkTarget, dest)
+            self.__applyMeta(dest, st)
+        else:
+            # Devices, FIFOs and sockets like rsync -D
+            isDevice = stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode)
+            if isDevice and not self.isRoot:
+                self.__log(f'skipping non-regular file "{rel[1:]}"')
+                return
+            if destStat is not None and (not isDevice or destStat.st_rdev == st.st_rdev):
+                self.__applyMeta(dest, st, destStat)
+                return
+            self.__log(rel[1:])
+            if destStat is None:
+                self.result.createdFiles += 1
+            if self.dry:
+                return
+            if destStat is not None:
+                os.unlink(dest)
+            os.mknod(dest, stat.S_IFMT(st.st_mode) | 0o600, st.st_rdev)
+            self.__applyMeta(dest, st)
+
+    def __remove(self, path, rel):
+        if rel in self.protected:
+            return
+        st = self.__lstat(path)
+        if st is None:
+            return
+
+        if stat.S_ISDIR(st.st_mode):
+            if st.st_dev != self.destDevice:
+                # Never delete anything on other file systems mounted into the work folder
+                return
+            with os.scandir(path) as it:
+                children = sorted(it, key=lambda e: e.name)
+            for entry in children:
+                self.__remove(entry.path, f'{rel}/{entry.name}')
+            self.__log(f'deleting {rel[1:]}/')
+            self.result.deletedFiles += 1
+            if not self.dry:
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    if e.errno != errno.ENOTEMPTY:
+                        raise
+                    # Protected content is kept
+        else:
+            self.__log(f'deleting {rel[1:]}')
+            self.result.deletedFiles += 1
+            if not self.dry:
+                os.unlink(path)
+
+    def __applyMeta(self, path, st, destStat=None):
+        if self.dry:
+            return
+
+        isLink = stat.S_ISLNK(st.st_mode)
+        if destStat is not None and not stat.S_ISDIR(st.st_mode):
+            # Folders are always updated as their times changed by the transfer of their content
+            if (
+                destStat.st_uid == st.st_uid and destStat.st_gid == st.st_gid and
+                stat.S_IMODE(destStat.st_mode) == stat.S_IMODE(st.st_mode) and
+                destStat.st_mtime_ns == st.st_mtime_ns
+            ):
+                return
+
+        if self.isRoot:
+            os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+        if not isLink:
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def __copyFile(self, source, dest, st):
+        fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=f'.{os.path.basename(dest)}.')
+        try:
+            with open(source, 'rb') as src:
+                self.__copyData(src.fileno(), fd, st)
+
+            if self.isRoot:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.close(fd)
+            fd = None
+            os.replace(tmpName, dest)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            os.unlink(tmpName)
+            raise
+
+    def __copyData(self, srcFd, destFd, st):
+        # The best working method is remembered per pair of devices
+        key = (st.st_dev, self.destDevice)
+        mode = self.copyModes.get(key, 'clone')
+
+        if mode == 'clone':
+            try:
+                fcntl.ioctl(destFd, self.FICLONE, srcFd)
+                self.result.matchedData += st.st_size
+                return
+            except OSError as e:
+                if e.errno not in self.__FALLBACK_ERRORS:
+                    raise
+                mode = 'range'
+                self.copyModes[key] = mode
+
+        if mode == 'range':
+            copied = 0
+            try:
+                while True:
+                    n = os.copy_file_range(srcFd, destFd, self.__CHUNK_SIZE)
+                    if n == 0:
+                        break
+                    copied += n
+                self.result.literalData += copied
+                return
+            except OSError as e:
+                if copied > 0 or e.errno not in self.__FALLBACK_ERRORS:
+                    raise
+                mode = 'copy'
+                self.copyModes[key] = mode
+
+        while True:
+            buf = os.read(srcFd, 1024 * 1024)
+            if len(buf) == 0:
+                break
+            view = memoryview(buf)
+            while len(view) > 0:
+                n = os.write(destFd, view)
+                view = view[n:]
+            self.result.literalData += len(buf)
+
+class ReflinkHelper:
+    def __init__(self, config: bup_backup.config.BackupConfig):
+        self.checked = False
+        self.config = config
+        self.copyModes = {}
+
+    def getOptions(self, index: int):
+        return ['reflink']
+
+    def check(self):
+        if not self.checked:
+            if not sys.platform.startswith('linux'):
+                raise ConfigurationException('The reflink staging is only available on Linux.')
+            self.checked = True
+
+    def execute(self, index: int, source: str, dest: str, verbose: bool, dry: bool, debug: bool, protectedDirs: list[str] = [], subPaths: list[str] = None):
+        if debug:
+            print('Reflink staging:', source, dest, 'protected:', protectedDirs, 'sub paths:', subPaths)
+
+        start = time.monotonic()
+        transfer = ReflinkTransfer(self.copyModes, protectedDirs, verbose, dry)
+        result = transfer.run(source, dest, subPaths)
+        result.duration = time.monotonic() - start
+
+        if debug:
+            print('Reflink copy modes:', self.copyModes)
+
+        return result
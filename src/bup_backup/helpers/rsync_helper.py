@@ -23,7 +23,63 @@ from .abstract_processing_helper import (
 from .config_helper import ConfigHelper
 
 import os
+import re
 import subprocess
+import time
+import concurrent.futures
+
+class RSyncResult:
+    # Lines of the output of rsync --stats and the corresponding attribute
+    STATS = [
+        (re.compile(r'Number of files: ([\d,.]+)'), 'files'),
+        (re.compile(r'Number of created files: ([\d,.]+)'), 'createdFiles'),
+        (re.compile(r'Number of deleted files: ([\d,.]+)'), 'deletedFiles'),
+        (re.compile(r'Number of (?:regular )?files transferred: ([\d,.]+)'), 'transferredFiles'),
+        (re.compile(r'Total file size: ([\d,.]+)'), 'totalSize'),
+        (re.compile(r'Total transferred file size: ([\d,.]+)'), 'transferredSize'),
+        (re.compile(r'Literal data: ([\d,.]+)'), 'literalData'),
+        (re.compile(r'Matched data: ([\d,.]+)'), 'matchedData'),
+        (re.compile(r'Total bytes sent: ([\d,.]+)'), 'bytesSent'),
+        (re.compile(r'Total bytes received: ([\d,.]+)'), 'bytesReceived'),
+    ]
+
+    def __init__(self):
+        self.runs = 0
+        self.duration = 0.0
+        for regex, name in self.STATS:
+            setattr(self, name, None)
+
+    def parseLine(self, line):
+        for regex, name in self.STATS:
+            match = regex.match(line.strip())
+            if match is not None:
+                setattr(self, name, int(re.sub(r'[,.]', '', match.group(1))))
+                return True
+        return False
+
+    def add(self, other):
+        self.runs += other.runs
+        for regex, name in self.STATS:
+            value = getattr(other, name)
+            if value is not None:
+                setattr(self, name, (getattr(self, name) or 0) + value)
+
+    def getSpeedup(self):
+        if self.totalSize is None or self.bytesSent is None or self.bytesReceived is None:
+            return None
+        if self.bytesSent + self.bytesReceived == 0:
+            return None
+        return self.totalSize / (self.bytesSent + self.bytesReceived)
+
+    def toDict(self):
+        ret = {
+            'runs': self.runs,
+            'duration': self.duration,
+        }
+        for regex, name in self.STATS:
+            ret[name] = getattr(self, name)
+        ret['speedup'] = self.getSpeedup()
+        return ret
 
 class RSyncHelper:
     __DEFAULT_SHORT_OPTIONS = '-ax'
@@ -45,6 +101,9 @@ class RSyncHelper:
         opts = self.configHelper.getOption(index, 'rsync_opts', self.__DEFAULT_OPTIONS)
         return opts.split(' ')
     
+    def getOptions(self, index: int):
+        return [self.__getShortOptions(index)] + self.__getLongOptions(index)
+
     def check(self):
         if not self.checked:
             rsyncPath = self.__getRSync()
@@ -56,16 +115,176 @@ class RSyncHelper:
             
             self.checked = True
     
-    def execute(self, index: int, source: str, dest: str, verbose: bool, dry: bool, debug: bool, protectedDirs: list[str] = []):
+    def execute(self, index: int, source: str, dest: str, verbose: bool, dry: bool, debug: bool, protectedDirs: list[str] = [], subPaths: list[str] = None, dirty=None):
+        shards = max(1, int(self.configHelper.getOption(index, 'rsync_shards', 1)))
+        result = RSyncResult()
+        start = time.monotonic()
+
+        if dirty is not None:
+            self.__executeDirty(index, source, dest, verbose, dry, debug, protectedDirs, dirty, result)
+        elif shards > 1:
+            self.__executeSharded(index, source, dest, verbose, dry, debug, protectedDirs, subPaths, shards, result)
+        elif subPaths is None:
+            result.add(self.__run(index, [self.__getRootSource(source)], dest, verbose, dry, debug, protectedDirs))
+        else:
+            result.add(self.__run(index, self.__getSubPathSources(source, subPaths), self.__getSubPathDest(dest), verbose, dry, debug, protectedDirs))
+
+        result.duration = time.monotonic() - start
+        return result
+
+    def __getRootSource(self, source):
         src = source
         if not src.endswith('/'):
             src = f"{src}/"
+        return src
+
+    def __getSubPathSources(self, source, subPaths):
+        # Only synchronize the given top level entries. Without trailing slash the paths keep
+        # their name relative to the transfer root, so the protection filters still apply.
+        return [os.path.join(source, p) for p in subPaths]
+
+    def __getSubPathDest(self, dest):
+        if not dest.endswith('/'):
+            dest = f"{dest}/"
+        return dest
+
+    def __getShardCandidates(self, source, protectedDirs):
+        device = os.stat(source).st_dev
+        candidates = []
+        with os.scandir(source) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if f'/{entry.name}' in protectedDirs:
+                    continue
+                # Like rsync -x, other file systems are not entered
+                if entry.stat(follow_symlinks=False).st_dev != device:
+                    continue
+                candidates.append(entry.name)
+        return sorted(candidates)
+
+    def __estimateSize(self, path):
+        size = 0
+        stack = [path]
+        device = os.stat(path).st_dev
+        while len(stack) > 0:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        st = entry.stat(follow_symlinks=False)
+                        if entry.is_dir(follow_symlinks=False):
+                            if st.st_dev == device:
+                                stack.append(entry.path)
+                        else:
+                            size += st.st_size
+            except OSError:
+                pass
+        return size
+
+    def __getShards(self, index, source, names, shards):
+        mode = self.configHelper.getOption(index, 'rsync_shard_mode', 'top')
+        if mode == 'top':
+            return [[name] for name in names]
+        elif mode == 'size':
+            with concurrent.futures.ThreadPoolExecutor(max_workers=shards) as executor:
+                sizes = list(executor.map(lambda name: self.__estimateSize(os.path.join(source, name)), names))
+
+            # Greedily put the largest folders into the currently smallest bucket
+            buckets = [(0, i, []) for i in range(shards)]
+            for size, name in sorted(zip(sizes, names), reverse=True):
+                bucketSize, i, bucketNames = min(buckets)
+                bucketNames.append(name)
+                buckets[i] = (bucketSize + size, i, bucketNames)
+            return [sorted(bucketNames) for bucketSize, i, bucketNames in buckets if len(bucketNames) > 0]
+        else:
+            raise ConfigurationException(f"The rsync shard mode {mode} is unknown.")
+
+    def __executeSharded(self, index, source, dest, verbose, dry, debug, protectedDirs, subPaths, shards, result):
+        if subPaths is None:
+            names = self.__getShardCandidates(source, protectedDirs)
+
+            # The top level is synchronized first without descending into the shards. The content
+            # of the shards is hidden from the transfer and protected from deletion.
+            shardFilters = []
+            for name in names:
+                shardFilters = shardFilters + [f'/{name}/*']
+            result.add(self.__run(index, [self.__getRootSource(source)], dest, verbose, dry, debug, protectedDirs + shardFilters))
+        else:
+            names = subPaths
+        
+        if len(names) == 0:
+            return
+
+        shardList = self.__getShards(index, source, names, shards)
+        if debug:
+            print('RSync shards:', shardList)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shards, thread_name_prefix='rsync') as executor:
+            futures = [
+                executor.submit(
+                    self.__run, index, self.__getSubPathSources(source, shard), self.__getSubPathDest(dest),
+                    verbose, dry, debug, protectedDirs
+                ) for shard in shardList
+            ]
+            concurrent.futures.wait(futures)
+            for f in futures:
+                result.add(f.result())
+
+    def __isBelow(self, path, parents):
+        for parent in parents:
+            if path == parent or path.startswith(f'{parent}/'):
+                return True
+        return False
+
+    def __getDirtyPaths(self, source, paths, protectedDirs, excluded):
+        ret = []
+        for path in sorted(set(paths)):
+            # Nested targets belong to other rows
+            if self.__isBelow(f'/{path}'.rstrip('/'), protectedDirs):
+                continue
+            if self.__isBelow(path, excluded):
+                continue
+            # Removed folders are handled by the deletion in their parent folder
+            fullPath = os.path.join(source, path)
+            if os.path.islink(fullPath) or not os.path.isdir(fullPath):
+                continue
+            ret.append(path)
+        return ret
+
+    def __executeDirty(self, index, source, dest, verbose, dry, debug, protectedDirs, dirty, result):
+        dirs, trees = dirty
+        trees = self.__getDirtyPaths(source, trees, protectedDirs, [])
+        # Trees nested in other trees are synchronized with them
+        nestedTrees = trees
+        trees = []
+        for tree in sorted(nestedTrees, key=lambda t: t.split('/')):
+            if len(trees) == 0 or not self.__isBelow(tree, [trees[-1]]):
+                trees.append(tree)
+        dirs = self.__getDirtyPaths(source, dirs, protectedDirs, trees)
+
+        if debug:
+            print('Dirty folders:', dirs)
+            print('Dirty trees:', trees)
+
+        # With --relative the paths below the ./ marker are kept, so the protection filters still apply
+        dest = self.__getSubPathDest(dest)
+        chunkSize = 1000
+        
+        # The changed folders are synchronized without recursion. Their obsolete entries are deleted.
+        for i in range(0, len(dirs), chunkSize):
+            srcs = [os.path.join(source, '.', d).rstrip('/') + '/' for d in dirs[i:i + chunkSize]]
+            result.add(self.__run(index, srcs, dest, verbose, dry, debug, protectedDirs, ['--no-recursive', '--dirs', '--relative']))
         
+        # New folders are synchronized completely as their content was not watched from the beginning.
+        for i in range(0, len(trees), chunkSize):
+            srcs = [os.path.join(source, '.', t) for t in trees[i:i + chunkSize]]
+            result.add(self.__run(index, srcs, dest, verbose, dry, debug, protectedDirs, ['--relative']))
+
+    def __run(self, index: int, srcs: list[str], dest: str, verbose: bool, dry: bool, debug: bool, protectedDirs: list[str], extraOptions: list[str] = []):
         cmd = [
             self.__getRSync(),
-            self.__getShortOptions(index)
-        ] + self.__getLongOptions(index) + [
-            src, dest
+        ] + self.getOptions(index) + extraOptions + ['--stats', '--no-human-readable'] + srcs + [
+            dest
         ]
 
         for pd in protectedDirs:
@@ -79,9 +298,19 @@ class RSyncHelper:
         if debug:
             print('RSync command line:', cmd)
         
-        sp = subprocess.run(cmd)
+        result = RSyncResult()
+        result.runs = 1
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, errors='replace') as proc:
+            for line in proc.stdout:
+                if verbose:
+                    print(line, end='')
+                result.parseLine(line)
+            returncode = proc.wait()
+
         if dry:
-            if sp.returncode != 0:
+            if returncode != 0:
                 print('Warning: rsync failed. This might be a problem.')
-        else:
-            sp.check_returncode()
+        elif returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+        return result
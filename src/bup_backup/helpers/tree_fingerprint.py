@@ -0,0 +1,138 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import bup_backup
+from .config_helper import ConfigHelper
+from .atomic_file import writeJson
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+
+class TreeFingerprint:
+    def __init__(self, config: bup_backup.config.BackupConfig):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+
+    def __getJobs(self, index):
+        return max(1, int(self.configHelper.getOption(index, 'fingerprint_jobs', 8)))
+
+    def __getStorePath(self, index):
+        folder = self.configHelper.getGlobalOption('fingerprint_dir', '/var/lib/bup-backup/fingerprints')
+        dynPart = f'{self.config.table[index].branch}:{self.config.table[index].target}'
+        return os.path.join(folder, f'{hashlib.md5(dynPart.encode()).hexdigest()}.json')
+
+    def __getEntryMeta(self, st):
+        return f'{stat.S_IFMT(st.st_mode)}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}:{st.st_ino}'
+
+    def __scanDir(self, path, device):
+        # Hashes the non-directory entries and returns the sub folders for further scanning
+        filesHash = hashlib.sha256()
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                meta = self.__getEntryMeta(st)
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append((entry.name, meta, st.st_dev == device))
+                else:
+                    filesHash.update(f'{entry.name}\0{meta}\0'.encode(errors='surrogateescape'))
+        except OSError:
+            # The folder changed while scanning. This is never equal to a stored fingerprint.
+            return (path, None, [])
+        
+        return (path, filesHash.hexdigest(), subdirs)
+
+    def scan(self, index, source):
+        rootStat = os.stat(source)
+        device = rootStat.st_dev
+        listings = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__getJobs(index), thread_name_prefix='fingerprint') as executor:
+            pending = {executor.submit(self.__scanDir, source, device)}
+            while len(pending) > 0:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    path, filesHash, subdirs = f.result()
+                    listings[path] = (filesHash, subdirs)
+                    for name, meta, sameDevice in subdirs:
+                        # Like rsync -x, do not descend into other file systems
+                        if sameDevice:
+                            pending.add(executor.submit(self.__scanDir, os.path.join(path, name), device))
+        
+        # Combine the hashes bottom up
+        hashes = {}
+        for path in sorted(listings.keys(), key=lambda p: p.count(os.sep), reverse=True):
+            hashes[path] = self.__combine(path, listings[path], hashes, includeSubtrees=True)
+        
+        # Changes within a top level folder alter its metadata. Thus, it belongs to the subtree and not to the root.
+        return {
+            'root': self.__combine(source, listings[source], hashes, includeSubtrees=False),
+            'subtrees': {name: self.__combineSubtree(meta, hashes.get(os.path.join(source, name))) for name, meta, sameDevice in listings[source][1] if sameDevice},
+        }
+
+    def __combineSubtree(self, meta, subHash):
+        if subHash is None:
+            return None
+        return hashlib.sha256(f'{meta}\0{subHash}'.encode()).hexdigest()
+
+    def __combine(self, path, listing, hashes, includeSubtrees: bool):
+        filesHash, subdirs = listing
+        if filesHash is None:
+            return None
+        
+        h = hashlib.sha256(filesHash.encode())
+        for name, meta, sameDevice in subdirs:
+            if includeSubtrees:
+                h.update(f'{name}\0{meta}\0'.encode(errors='surrogateescape'))
+                if sameDevice:
+                    subHash = hashes.get(os.path.join(path, name))
+                    if subHash is None:
+                        return None
+                    h.update(subHash.encode())
+            elif sameDevice:
+                h.update(f'{name}\0'.encode(errors='surrogateescape'))
+            else:
+                # Mount points on other file systems are no subtrees of their own
+                h.update(f'{name}\0{meta}\0'.encode(errors='surrogateescape'))
+        return h.hexdigest()
+
+    def load(self, index):
+        path = self.__getStorePath(index)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    def store(self, index, data):
+        writeJson(self.__getStorePath(index), data, prefix='.fingerprint-', folderMode=0o700)
+
+    def getChangedSubtrees(self, old, new):
+        # Returns None if the whole tree needs to be synchronized
+        if old is None or new['root'] is None or old['root'] != new['root']:
+            return None
+        
+        changed = []
+        for name in new['subtrees'].keys():
+            if new['subtrees'][name] is None or old['subtrees'].get(name) != new['subtrees'][name]:
+                changed.append(name)
+        return changed
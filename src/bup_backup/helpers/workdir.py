@@ -18,6 +18,7 @@
 # from .config import BackupConfig
 import bup_backup
 from .config_helper import ConfigHelper
+from .mount_helper import MountHelper
 
 import os
 import shutil
@@ -47,6 +48,25 @@ class Workdir:
     def getWorkingPath(self, index: int):
         return os.path.join(self.getWorkingBasePath(), self.getRelativeWorkingPath(index))
     
+    def isStreamed(self, index: int):
+        # Streamed rows are stored by bup split and have no data in the work folder
+        if self.config.table[index].type == 'lvm-raw':
+            return True
+        return self.config.table[index].type == 'command' and self.configHelper.getBoolOption(index, 'stream')
+
+    def isGrafted(self, index: int):
+        return self.configHelper.getOption(index, 'staging', 'rsync') == 'graft'
+
+    def getSavePath(self, index: int):
+        # Grafted rows are saved from where the data is located without staging
+        if self.isGrafted(index):
+            if self.config.table[index].type == 'plain':
+                return self.config.table[index].source
+            else:
+                return MountHelper(self.config).getMountPoint(index)
+        
+        return self.getWorkingPath(index)
+    
     def ensureWorkingPathExists(self, index: int, dry: bool, emptyDir: bool = False):
         path = self.getWorkingPath(index)
         self.ensurePathExists(path, dry, emptyDir)
@@ -63,6 +83,6 @@ class Workdir:
             if dry:
                 print(f"Creating folder {path}.")
             else:
-                os.makedirs(path)
+                os.makedirs(path, exist_ok=True)
     
     
\ No newline at end of file
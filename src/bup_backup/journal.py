@@ -0,0 +1,123 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import bup_backup
+from .helpers.abstract_processing_helper import ConfigurationException
+from .helpers.config_helper import ConfigHelper
+from .helpers.atomic_file import writeJson
+
+import json
+import os
+import threading
+
+class RunJournal:
+    def __init__(self, config: bup_backup.config.BackupConfig, dry: bool, verbose: bool, debug: bool):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+
+        self.dry = dry
+        self.verbose = verbose
+        self.debug = debug
+
+        self.path = self.configHelper.getGlobalOption('journal_file', '/var/lib/bup-backup/journal.json')
+        self.lock = threading.RLock()
+        self.data = self.__getEmptyData()
+
+    def __getEmptyData(self):
+        return {
+            'rows': {},
+            'branches': {},
+        }
+
+    def __getRowKey(self, index):
+        return f'{self.config.table[index].branch}:{self.config.table[index].target}'
+
+    def __getRow(self, index):
+        return self.data['rows'].setdefault(self.__getRowKey(index), {
+            'prepared': False,
+            'steps': [],
+        })
+
+    def __write(self):
+        if self.dry:
+            return
+        
+        writeJson(self.path, self.data, prefix='.journal-', folderMode=0o700, sync=True)
+
+    def load(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as fp:
+                    self.data = json.load(fp)
+                if self.verbose:
+                    print(f'Resuming from run journal {self.path}.')
+            else:
+                if self.verbose:
+                    print(f'There is no run journal at {self.path}. Starting from scratch.')
+                self.data = self.__getEmptyData()
+            
+            knownKeys = [self.__getRowKey(i) for i in range(0, len(self.config.table))]
+            for key in self.data['rows'].keys():
+                if key not in knownKeys and len(self.data['rows'][key]['steps']) > 0:
+                    print(f'Warning: The journal contains leftovers of {key} which is no longer in the backup table. Please clean up manually.')
+
+    def reset(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as fp:
+                    oldData = json.load(fp)
+                leftovers = [key for key in oldData['rows'].keys() if len(oldData['rows'][key]['steps']) > 0]
+                if len(leftovers) > 0:
+                    raise ConfigurationException(f"A previous run did not finish and left {', '.join(leftovers)} behind. Use --resume to clean up and continue.")
+            
+            self.data = self.__getEmptyData()
+            self.__write()
+
+    def finish(self):
+        with self.lock:
+            if self.debug:
+                print(f'Removing run journal {self.path}.')
+            if not self.dry and os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def setMiddlewareSteps(self, index, steps):
+        with self.lock:
+            self.__getRow(index)['steps'] = [list(step) for step in steps]
+            self.__write()
+
+    def getMiddlewareSteps(self, index):
+        with self.lock:
+            return [tuple(step) for step in self.__getRow(index)['steps']]
+
+    def setRowPrepared(self, index, prepared: bool = True):
+        with self.lock:
+            self.__getRow(index)['prepared'] = prepared
+            self.__write()
+
+    def isRowPrepared(self, index):
+        with self.lock:
+            return self.__getRow(index)['prepared']
+
+    def markBranchSaved(self, branch):
+        with self.lock:
+            self.data['branches'][branch] = 'saved'
+            self.__write()
+
+    def isBranchSaved(self, branch):
+        with self.lock:
+            return self.data['branches'].get(branch) == 'saved'
@@ -15,68 +15,180 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
 import os
 import subprocess
+import threading
+
+class LvmMetadata:
+    __instance = None
+    __instanceLock = threading.Lock()
+
+    __LV_FIELDS = 'lv_name,vg_name,lv_path,lv_dm_path,lv_attr,lv_size,origin,pool_lv,data_percent,metadata_percent,thin_id'
+    __VG_FIELDS = 'vg_name,vg_extent_size,vg_extent_count,vg_free_count,vg_size,vg_free'
+
+    @classmethod
+    def getInstance(cls):
+        with cls.__instanceLock:
+            if cls.__instance is None:
+                cls.__instance = LvmMetadata()
+            return cls.__instance
 
-class Vg:
     def __init__(self):
-        self.cache = {}
-    
-    def __getVgDisplay(self, name):
-        if name not in self.cache.keys():
-            sp = subprocess.run(['vgdisplay', '-c', name], capture_output=True, text=True)
-            sp.check_returncode()
-            self.cache[name] = sp.stdout.strip().split(':')
+        self.lock = threading.RLock()
+        self.lvs = None
+        self.vgs = None
+        self.lvIndex = None
+
+    def __report(self, cmd, section):
+        sp = subprocess.run(cmd + ['--reportformat', 'json', '--units', 'b', '--nosuffix'], capture_output=True, text=True)
+        sp.check_returncode()
+        data = json.loads(sp.stdout)
+        ret = []
+        for report in data['report']:
+            ret.extend(report.get(section, []))
+        return ret
+
+    def __load(self):
+        if self.lvs is None:
+            # A single call for each type scans the PVs only once for all queries
+            self.lvs = self.__report(['lvs', '-o', self.__LV_FIELDS], 'lv')
+            self.vgs = {vg['vg_name']: vg for vg in self.__report(['vgs', '-o', self.__VG_FIELDS], 'vg')}
 
-        return self.cache[name]
+            self.lvIndex = {}
+            for lv in self.lvs:
+                for key in (lv.get('lv_path', ''), lv.get('lv_dm_path', ''), f"{lv['vg_name']}/{lv['lv_name']}"):
+                    if key != '':
+                        self.lvIndex[key] = lv
+
+    def invalidate(self):
+        with self.lock:
+            self.lvs = None
+            self.vgs = None
+            self.lvIndex = None
+
+    def findLv(self, name):
+        with self.lock:
+            self.__load()
+            if name in self.lvIndex.keys():
+                return self.lvIndex[name]
+            
+            # Other device names like /dev/dm-3 or symlinks
+            realName = os.path.realpath(name)
+            for lv in self.lvs:
+                if lv.get('lv_path', '') != '' and os.path.realpath(lv['lv_path']) == realName:
+                    return lv
+            return None
+
+    def getLv(self, name):
+        lv = self.findLv(name)
+        if lv is None:
+            raise Exception(f'{name} is no valid LV.')
+        return lv
+
+    def getVg(self, name):
+        with self.lock:
+            self.__load()
+            if name not in self.vgs.keys():
+                raise Exception(f'{name} is no valid VG.')
+            return self.vgs[name]
+
+class Vg:
+    def __init__(self):
+        self.metadata = LvmMetadata.getInstance()
 
     def getPeSize(self, name):
-        return int(self.__getVgDisplay(name)[12]) * 1024
+        return int(self.metadata.getVg(name)['vg_extent_size'])
     
     def getFreeSizePE(self, name):
-        return int(self.__getVgDisplay(name)[15])
+        return int(self.metadata.getVg(name)['vg_free_count'])
     
     def getFreeSize(self, name):
         return self.getFreeSizePE(name) * self.getPeSize(name)
     
     def hasLv(self, name):
-        sp = subprocess.run(['lvdisplay', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if sp.returncode == 0:
-            return True
-        elif sp.returncode == 5:
-            return False
-        else:
-            raise Exception(f"Could not detect if {name} is a valid LV")
+        return self.metadata.findLv(name) is not None
 
 class Lv:
     def __init__(self):
-        self.cache = {}
-    
-    def __getLvDisplay(self, name):
-        if name not in self.cache.keys():
-            sp = subprocess.run(['lvdisplay', '-c', name], capture_output=True, text=True)
-            sp.check_returncode()
-            self.cache[name] = sp.stdout.strip().split(':')
-        
-        return self.cache[name]
+        self.metadata = LvmMetadata.getInstance()
     
     def getVgName(self, name):
-        return self.__getLvDisplay(name)[1]
+        return self.metadata.getLv(name)['vg_name']
 
-    def getFullSnapshotName(self, original, snapName):
-        vgName = self.getVgName(original)
-        return f'/dev/{vgName}/{snapName}'
+    def getSize(self, name):
+        return int(self.metadata.getLv(name)['lv_size'])
+
+    def getDataPercent(self, name):
+        value = self.metadata.getLv(name)['data_percent']
+        return float(value) if value != '' else None
+
+    def getMetadataPercent(self, name):
+        value = self.metadata.getLv(name)['metadata_percent']
+        return float(value) if value != '' else None
+
+    def isThin(self, name):
+        return self.metadata.getLv(name)['pool_lv'] != ''
+
+    def getThinPool(self, name):
+        lv = self.metadata.getLv(name)
+        return f"{lv['vg_name']}/{lv['pool_lv']}"
+
+    def getThinId(self, name):
+        return int(self.metadata.getLv(name)['thin_id'])
 
-    def createSnapshot(self, name, snapName, size, dry, verbose, debug):
+    def getDmName(self, name):
+        # Device mapper doubles the dashes in the VG and LV names
+        lv = self.metadata.getLv(name)
+        return f"{lv['vg_name'].replace('-', '--')}-{lv['lv_name'].replace('-', '--')}"
+
+    def rename(self, name, newName, dry, verbose, debug):
         if verbose:
-            print(f'Creating snapshort {snapName} for LV {name} with size {size}.')
+            print(f'Renaming LV {name} to {newName}.')
         
         cmd = [
-            'lvcreate', '--snapshot',
-            '--name', snapName,
-            '--size', size,
-            name
+            'lvrename',
+            self.getVgName(name),
+            self.metadata.getLv(name)['lv_name'],
+            newName
         ]
+        if debug:
+            print('Rename command', cmd)
+
+        if dry:
+            print(f'Renaming of LV {name}.')
+        else:
+            try:
+                subprocess.run(cmd).check_returncode()
+            finally:
+                self.metadata.invalidate()
+
+    def getFullSnapshotName(self, original, snapName):
+        vgName = self.getVgName(original)
+        return f'/dev/{vgName}/{snapName}'
+
+    def createSnapshot(self, name, snapName, size, dry, verbose, debug, thin=False):
+        if thin:
+            if verbose:
+                print(f'Creating thin snapshort {snapName} for LV {name}.')
+            
+            # Thin snapshots are skipped on activation by default
+            cmd = [
+                'lvcreate', '--snapshot',
+                '--setactivationskip', 'n',
+                '--name', snapName,
+                name
+            ]
+        else:
+            if verbose:
+                print(f'Creating snapshort {snapName} for LV {name} with size {size}.')
+            
+            cmd = [
+                'lvcreate', '--snapshot',
+                '--name', snapName,
+                '--size', size,
+                name
+            ]
         if not verbose:
             cmd.append('-q')
         
@@ -86,10 +198,36 @@ class Lv:
         if dry:
             print(f'Creation of snapshot {snapName}.')
         else:
-            subprocess.run(cmd).check_returncode()
+            try:
+                subprocess.run(cmd).check_returncode()
+            finally:
+                self.metadata.invalidate()
         
         return self.getFullSnapshotName(name, snapName)
     
+    def extend(self, name, amount, dry, verbose, debug):
+        if verbose:
+            print(f'Extending LV {name} by {amount/1024.0/1024:1.1f} MB.')
+        
+        cmd = [
+            'lvextend',
+            '--size', f'+{int(amount / 1024)}k',
+            name
+        ]
+        if not verbose:
+            cmd.append('-q')
+        
+        if debug:
+            print('Extension command', cmd)
+
+        if dry:
+            print(f'Extension of LV {name}.')
+        else:
+            try:
+                subprocess.run(cmd).check_returncode()
+            finally:
+                self.metadata.invalidate()
+
     def removeSnapshot(self, snapName, dry, verbose, debug):
         if verbose:
             print(f'Removing snapshort {snapName}.')
@@ -108,4 +246,7 @@ class Lv:
         if dry:
             print(f'Removal of snapshot {snapName}.')
         else:
-            subprocess.run(cmd).check_returncode()
+            try:
+                subprocess.run(cmd).check_returncode()
+            finally:
+                self.metadata.invalidate()
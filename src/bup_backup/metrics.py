@@ -0,0 +1,138 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from .helpers.atomic_file import writeJson
+
+import threading
+
+class BranchMetrics:
+    def __init__(self, branch):
+        self.branch = branch
+
+        self.indexedPaths = None
+        self.indexDuration = None
+        self.savedFiles = None
+        self.savedBytes = None
+        self.newBytes = None
+        self.saveDuration = None
+
+    def toDict(self):
+        return {
+            'indexedPaths': self.indexedPaths,
+            'indexDuration': self.indexDuration,
+            'savedFiles': self.savedFiles,
+            'savedBytes': self.savedBytes,
+            'newBytes': self.newBytes,
+            'saveDuration': self.saveDuration,
+        }
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.branches = {}
+        self.indexRuns = []
+        self.rows = []
+        self.snapshots = []
+
+    def getBranch(self, branch) -> BranchMetrics:
+        with self.lock:
+            if branch not in self.branches.keys():
+                self.branches[branch] = BranchMetrics(branch)
+            return self.branches[branch]
+
+    def addIndexRun(self, repo, paths, indexedPaths, duration):
+        with self.lock:
+            self.indexRuns.append({
+                'repository': repo,
+                'paths': paths,
+                'indexedPaths': indexedPaths,
+                'duration': duration,
+            })
+
+    def addRowTransfer(self, tableLine, result):
+        with self.lock:
+            self.rows.append({
+                'branch': tableLine.branch,
+                'target': tableLine.target,
+                'source': tableLine.source,
+                'transfer': result.toDict(),
+            })
+
+    def addSnapshotUsage(self, tableLine, snapName, peakPercent, peakBytes, extendedBytes, duration):
+        with self.lock:
+            self.snapshots.append({
+                'branch': tableLine.branch,
+                'target': tableLine.target,
+                'source': tableLine.source,
+                'snapshot': snapName,
+                'peakPercent': peakPercent,
+                'peakBytes': peakBytes,
+                'extendedBytes': extendedBytes,
+                'duration': duration,
+            })
+
+    def toDict(self):
+        with self.lock:
+            return {
+                'branches': {branch: self.branches[branch].toDict() for branch in sorted(self.branches.keys())},
+                'indexRuns': list(self.indexRuns),
+                'rows': list(self.rows),
+                'snapshots': list(self.snapshots),
+            }
+
+    def write(self, path):
+        data = self.toDict()
+        writeJson(path, data, prefix='.metrics-', indent=2)
+
+    def __formatSize(self, size):
+        if size is None:
+            return '-'
+        return f'{size/1024.0/1024:1.1f} MB'
+
+    def __formatNumber(self, value, fmt):
+        if value is None:
+            return '-'
+        return format(value, fmt)
+
+    def printSummary(self):
+        print('Branch metrics:')
+        for branch in sorted(self.branches.keys()):
+            m = self.branches[branch]
+            print(
+                f'  {branch}: indexed {self.__formatNumber(m.indexedPaths, "d")} paths in {self.__formatNumber(m.indexDuration, ".1f")}s,',
+                f'saved {self.__formatNumber(m.savedFiles, "d")} files ({self.__formatSize(m.savedBytes)}, new {self.__formatSize(m.newBytes)})',
+                f'in {self.__formatNumber(m.saveDuration, ".1f")}s'
+            )
+
+        if len(self.rows) > 0:
+            print('Row transfers:')
+        for row in sorted(self.rows, key=lambda r: r['transfer']['duration'], reverse=True):
+            t = row['transfer']
+            print(
+                f'  {row["branch"]}:{row["target"]}: {self.__formatNumber(t["transferredFiles"], "d")} of {self.__formatNumber(t["files"], "d")} files transferred,',
+                f'{self.__formatNumber(t["deletedFiles"], "d")} deleted, sent {self.__formatSize(t["bytesSent"])},',
+                f'speedup {self.__formatNumber(t["speedup"], ".1f")} in {t["duration"]:.1f}s'
+            )
+
+        if len(self.snapshots) > 0:
+            print('Snapshot usage:')
+        for snapshot in self.snapshots:
+            print(
+                f'  {snapshot["branch"]}:{snapshot["target"]}: peak {snapshot["peakPercent"]:.1f}% ({self.__formatSize(snapshot["peakBytes"])}),',
+                f'extended by {self.__formatSize(snapshot["extendedBytes"])} in {snapshot["duration"]:.1f}s'
+            )
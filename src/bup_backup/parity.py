@@ -0,0 +1,133 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import fcntl
+import os
+import subprocess
+import sys
+
+class ParityGenerator:
+    def __init__(self, bupCmd, repo, jobs: int, verbose: bool, dry: bool, debug: bool):
+        self.bupCmd = bupCmd
+        self.repo = repo
+        self.jobs = max(1, jobs)
+
+        self.verbose = verbose
+        self.dry = dry
+        self.debug = debug
+
+    def getLockPath(self):
+        return os.path.join(self.repo, 'bup-backup-parity.lock')
+
+    def getPacksWithoutParity(self):
+        packFolder = os.path.join(self.repo, 'objects', 'pack')
+        if not os.path.isdir(packFolder):
+            return []
+        
+        names = set(os.listdir(packFolder))
+        packs = []
+        for name in sorted(names):
+            if not name.endswith('.pack'):
+                continue
+            base = name[0:-len('.pack')]
+            if f'{base}.par2' not in names:
+                packs.append(os.path.join(packFolder, name))
+        return packs
+
+    def generate(self, incremental: bool):
+        if self.dry:
+            print(f'Generating backup parity blocks in {self.repo}')
+            return
+        
+        # Only one parity job may run per repository, e.g. a detached one from the previous run.
+        with open(self.getLockPath(), 'w') as lockFile:
+            if self.verbose:
+                print(f'Waiting for the parity lock of {self.repo}.')
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+            cmd = [
+                self.bupCmd, '-d', self.repo,
+                'fsck', '-g', '-j', str(self.jobs)
+            ]
+            if incremental:
+                packs = self.getPacksWithoutParity()
+                if len(packs) == 0:
+                    if self.verbose:
+                        print(f'All packs in {self.repo} have parity information already.')
+                    return
+                cmd = cmd + packs
+            
+            if self.debug:
+                print('Terminal command', cmd)
+            
+            sp = subprocess.run(
+                cmd,
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE,
+                text=True
+            )
+
+            if sp.returncode != 0:
+                print(sp.stdout)
+                raise Exception(f'Error during bup fsck run. Please revisit your archive {self.repo}.')
+
+    def startDetached(self, incremental: bool, logFile: str):
+        cmd = [
+            sys.executable, '-c', 'import bup_backup.parity; bup_backup.parity.main()',
+            '--bup', self.bupCmd,
+            '--repo', self.repo,
+            '--jobs', str(self.jobs),
+        ]
+        if incremental:
+            cmd.append('--incremental')
+        
+        if self.debug:
+            print('Detached parity command', cmd)
+        
+        if self.dry:
+            print(f'Starting detached parity generation in {self.repo}')
+            return
+        
+        if self.verbose:
+            print(f'Generating parity blocks of {self.repo} in the background. See {logFile} for the output.')
+        
+        env = dict(os.environ)
+        packageBase = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([packageBase] + [p for p in [env.get('PYTHONPATH', '')] if p != ''])
+
+        os.makedirs(os.path.dirname(logFile), exist_ok=True)
+        with open(logFile, 'a') as log:
+            subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=env,
+                start_new_session=True
+            )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bup', required=True)
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--incremental', action='store_true')
+    args = parser.parse_args()
+
+    ParityGenerator(args.bup, args.repo, args.jobs, verbose=True, dry=False, debug=False).generate(args.incremental)
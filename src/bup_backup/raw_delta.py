@@ -0,0 +1,259 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bup_backup
+from .helpers.config_helper import ConfigHelper
+from .helpers.atomic_file import writeJson
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import xml.etree.ElementTree
+
+class BlockMap:
+    # Describes the content of one split of a raw device. The data of a full map is the complete
+    # image. Otherwise, the data contains the given ranges in this order and the zero ranges were discarded.
+    VERSION = 1
+
+    def __init__(self, mapType, size, data=None, ranges=[], zero=[]):
+        self.mapType = mapType
+        self.size = size
+        self.data = data
+        self.ranges = ranges
+        self.zero = zero
+
+    def toJson(self):
+        return json.dumps({
+            'version': self.VERSION,
+            'type': self.mapType,
+            'size': self.size,
+            'data': self.data,
+            'ranges': self.ranges,
+            'zero': self.zero,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def fromJson(cls, text):
+        data = json.loads(text)
+        if data.get('version') != cls.VERSION:
+            raise Exception(f"Unsupported block map version {data.get('version')}.")
+        return BlockMap(data['type'], data['size'], data['data'], data['ranges'], data['zero'])
+
+class ThinDelta:
+    # A pool holds at most one metadata snapshot, so rows on the same pool must take turns
+    __poolLocks = {}
+    __poolLocksLock = threading.Lock()
+
+    def __init__(self, config: bup_backup.config.BackupConfig, verbose: bool, debug: bool):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+        self.verbose = verbose
+        self.debug = debug
+
+    def __getPoolLock(self, pool):
+        with self.__poolLocksLock:
+            return self.__poolLocks.setdefault(pool, threading.Lock())
+
+    def __getPoolDevice(self, pool):
+        return f'{bup_backup.lvm.Lv().getDmName(pool)}-tpool'
+
+    def __dmsetupMessage(self, device, message):
+        cmd = [self.configHelper.getGlobalOption('dmsetup', 'dmsetup'), 'message', device, '0', message]
+        if self.debug:
+            print('dmsetup command line:', cmd)
+        return subprocess.run(cmd).returncode
+
+    def __reserveMetadataSnapshot(self, pool):
+        poolDevice = self.__getPoolDevice(pool)
+        if self.__dmsetupMessage(poolDevice, 'reserve_metadata_snap') == 0:
+            return
+        
+        # A killed run might have left its metadata snapshot behind
+        print(f'Warning: Cannot reserve a metadata snapshot of {pool}. Releasing a leftover one and retrying.')
+        self.__dmsetupMessage(poolDevice, 'release_metadata_snap')
+        if self.__dmsetupMessage(poolDevice, 'reserve_metadata_snap') != 0:
+            raise Exception(f'Cannot reserve a metadata snapshot of the thin pool {pool}.')
+
+    def releaseMetadataSnapshot(self, pool, dry):
+        # Releases a metadata snapshot left over by an interrupted run
+        if dry:
+            print(f'Releasing a leftover metadata snapshot of {pool}.')
+            return
+        
+        with self.__getPoolLock(pool):
+            cmd = [self.configHelper.getGlobalOption('dmsetup', 'dmsetup'), 'message', self.__getPoolDevice(pool), '0', 'release_metadata_snap']
+            if self.debug:
+                print('dmsetup command line:', cmd)
+            # Fails if there is no metadata snapshot
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __mergeRanges(self, ranges):
+        ret = []
+        for begin, length in sorted(ranges):
+            if len(ret) > 0 and ret[-1][0] + ret[-1][1] == begin:
+                ret[-1][1] += length
+            else:
+                ret.append([begin, length])
+        return ret
+
+    def __runThinDelta(self, cmd):
+        changed = []
+        zero = []
+        blockSize = None
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            for event, elem in xml.etree.ElementTree.iterparse(proc.stdout, events=('start', 'end')):
+                if event == 'end':
+                    elem.clear()
+                    continue
+                if elem.tag == 'superblock':
+                    blockSize = int(elem.get('data_block_size')) * 512
+                elif elem.tag in ('different', 'right_only'):
+                    changed.append((int(elem.get('begin')), int(elem.get('length'))))
+                elif elem.tag == 'left_only':
+                    zero.append((int(elem.get('begin')), int(elem.get('length'))))
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise Exception(f'thin_delta terminated with return code {returncode}.')
+        
+        return (blockSize, changed, zero)
+
+    def getChanges(self, pool, baseId, newId, size):
+        # Returns the changed and the discarded byte ranges between two thin devices of a pool
+        lv = bup_backup.lvm.Lv()
+        metadataDevice = f'/dev/mapper/{lv.getDmName(pool)}_tmeta'
+
+        cmd = [
+            self.configHelper.getGlobalOption('thin_delta', 'thin_delta'),
+            '--metadata-snap',
+            '--snap1', str(baseId),
+            '--snap2', str(newId),
+            metadataDevice
+        ]
+        if self.debug:
+            print('thin_delta command line:', cmd)
+
+        # The live metadata can change at any time. thin_delta needs a consistent snapshot of it.
+        with self.__getPoolLock(pool):
+            self.__reserveMetadataSnapshot(pool)
+            try:
+                blockSize, changed, zero = self.__runThinDelta(cmd)
+            finally:
+                if self.__dmsetupMessage(self.__getPoolDevice(pool), 'release_metadata_snap') != 0:
+                    print(f'Warning: Cannot release the metadata snapshot of {pool}. The next run will retry.')
+
+        if blockSize is None:
+            raise Exception('Cannot parse the output of thin_delta.')
+
+        def toBytes(ranges):
+            ret = []
+            for begin, length in self.__mergeRanges(ranges):
+                offset = begin * blockSize
+                if offset >= size:
+                    continue
+                ret.append([offset, min(length * blockSize, size - offset)])
+            return ret
+
+        return (toBytes(changed), toBytes(zero))
+
+class RawDeltaStore:
+    def __init__(self, config: bup_backup.config.BackupConfig):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+
+    def __getStorePath(self, index):
+        folder = self.configHelper.getGlobalOption('raw_delta_dir', '/var/lib/bup-backup/raw-delta')
+        dynPart = f'{self.config.table[index].branch}:{self.config.table[index].target}'
+        return os.path.join(folder, f'{hashlib.md5(dynPart.encode()).hexdigest()}.json')
+
+    def load(self, index):
+        path = self.__getStorePath(index)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    def store(self, index, data):
+        writeJson(self.__getStorePath(index), data, prefix='.raw-delta-', folderMode=0o700)
+
+def rebuild(bupCmd, repo, name, output, gitCmd='git'):
+    # Collect the maps back to the last full image
+    sp = subprocess.run(
+        [gitCmd, '--git-dir', repo, 'rev-list', '--first-parent', f'refs/heads/{name}.map'],
+        capture_output=True, text=True
+    )
+    sp.check_returncode()
+
+    maps = []
+    for ref in sp.stdout.split():
+        sp = subprocess.run([bupCmd, '-d', repo, 'join', ref], capture_output=True, text=True)
+        sp.check_returncode()
+        blockMap = BlockMap.fromJson(sp.stdout)
+        maps.append(blockMap)
+        if blockMap.mapType == 'full':
+            break
+    if len(maps) == 0 or maps[-1].mapType != 'full':
+        raise Exception(f'There is no full image in the history of {name}.')
+
+    chunkSize = 4 * 1024 * 1024
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        for blockMap in reversed(maps):
+            os.ftruncate(fd, blockMap.size)
+            ranges = blockMap.ranges if blockMap.mapType == 'delta' else [[0, blockMap.size]]
+
+            for offset, length in blockMap.zero:
+                pos = offset
+                while pos < offset + length:
+                    pos += os.pwrite(fd, bytes(min(chunkSize, offset + length - pos)), pos)
+
+            proc = subprocess.Popen([bupCmd, '-d', repo, 'join', blockMap.data], stdout=subprocess.PIPE)
+            try:
+                for offset, length in ranges:
+                    pos = offset
+                    while pos < offset + length:
+                        data = proc.stdout.read(min(chunkSize, offset + length - pos))
+                        if len(data) == 0:
+                            raise Exception(f'The data of {blockMap.data} is shorter than its block map.')
+                        pos += os.pwrite(fd, data, pos)
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                raise Exception(f"'bup join' terminated with return code {returncode}.")
+    finally:
+        os.close(fd)
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the image of a raw row stored with raw_mode=delta')
+    parser.add_argument('--bup', default='bup')
+    parser.add_argument('--git', default='git')
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--name', required=True, help='The split name of the row')
+    parser.add_argument('output')
+    args = parser.parse_args()
+
+    rebuild(args.bup, args.repo, args.name, args.output, args.git)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import bup_backup
+from .helpers.mount_helper import MountHelper
+
+import concurrent.futures
+
+class PrepareScheduler:
+    def __init__(self, config: bup_backup.config.BackupConfig, helperMap, jobs: int, verbose: bool, debug: bool, journal=None, metrics=None):
+        self.config = config
+        self.helperMap = helperMap
+        self.jobs = max(1, jobs)
+        self.journal = journal
+        self.metrics = metrics
+        self.sourceMap = None
+        self.mountMap = None
+
+        self.verbose = verbose
+        self.debug = debug
+
+    def __getSourceMap(self):
+        sourceMap = {}
+        for index, row in enumerate(self.config.table):
+            sourceMap.setdefault(row.source, []).append(index)
+        return sourceMap
+
+    def __getMountMap(self):
+        # A mount_path in the common config makes several rows use the same mount point
+        mountHelper = MountHelper(self.config)
+        mountMap = {}
+        for index, row in enumerate(self.config.table):
+            if row.type in ('lvm', 'lvm+crypt'):
+                mountMap.setdefault(mountHelper.getMountPoint(index), []).append(index)
+        return mountMap
+
+    def getDependencies(self, index):
+        # Rows are sorted by branch and target, so a parent always comes before its nested targets.
+        deps = set(self.config.targetIndex.getParentIndices(index))
+
+        # Rows of the same source share the temporary mount point
+        if self.sourceMap is None:
+            self.sourceMap = self.__getSourceMap()
+        deps.update(i for i in self.sourceMap[self.config.table[index].source] if i < index)
+
+        if self.config.table[index].type in ('lvm', 'lvm+crypt'):
+            if self.mountMap is None:
+                self.mountMap = self.__getMountMap()
+            mountPoint = MountHelper(self.config).getMountPoint(index)
+            deps.update(i for i in self.mountMap[mountPoint] if i < index)
+
+        return sorted(deps)
+
+    def __prepareRow(self, index, depFutures):
+        for f in depFutures:
+            if f.exception() is not None:
+                raise Exception(f"Skipping preparation of {self.config.table[index].source} as a row it depends on failed.")
+
+        if self.journal is not None and self.__isDoneInJournal(index):
+            if self.verbose:
+                print(f"Skipping preparation of {self.config.table[index].source} as it was completed in a previous run.")
+            return
+
+        helper = self.helperMap[self.config.table[index].type]
+
+        if self.verbose:
+            print(f"Prepare step for backing up {self.config.table[index].source}.")
+        
+        result = helper.prepareBackup(index)
+
+        if self.metrics is not None and result is not None:
+            self.metrics.addRowTransfer(self.config.table[index], result)
+
+        if self.journal is not None:
+            self.journal.setRowPrepared(index)
+
+        if self.verbose:
+            print(f"Backup preparation step for {self.config.table[index].source} completed.")
+
+    def __isDoneInJournal(self, index):
+        return self.journal.isBranchSaved(self.config.table[index].branch) or self.journal.isRowPrepared(index)
+
+    def __getBranchOrder(self):
+        branches = []
+        for row in self.config.table:
+            if row.branch not in branches:
+                branches.append(row.branch)
+        return branches
+
+    def runByBranch(self):
+        futures = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='prepare')
+        try:
+            # The executor starts tasks in submission order, so any dependency is already running
+            # once a row waits for it. This rules out dead locks even with a single worker.
+            for index in range(0, len(self.config.table)):
+                depFutures = [futures[i] for i in self.getDependencies(index)]
+                if self.debug:
+                    print(f'Row {index} depends on rows', self.getDependencies(index))
+                futures.append(executor.submit(self.__prepareRow, index, depFutures))
+
+            for branch in self.__getBranchOrder():
+                branchFutures = [futures[i] for i in range(0, len(futures)) if self.config.table[i].branch == branch]
+                for f in branchFutures:
+                    f.result()
+                yield branch
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        else:
+            executor.shutdown(wait=True)
+
+    def run(self):
+        for branch in self.runByBranch():
+            pass
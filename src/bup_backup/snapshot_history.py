@@ -0,0 +1,79 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bup_backup
+from .helpers.config_helper import ConfigHelper
+from .helpers.atomic_file import writeJson
+
+import json
+import math
+import os
+import time
+
+class SnapshotHistory:
+    def __init__(self, config: bup_backup.config.BackupConfig):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+        self.path = self.configHelper.getGlobalOption('snap_history_file', '/var/lib/bup-backup/snapshot-history.json')
+        self.data = None
+
+    def __getRowKey(self, branch, target):
+        return f'{branch}:{target}'
+
+    def load(self):
+        if self.data is None:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as fp:
+                    self.data = json.load(fp)
+            else:
+                self.data = {}
+        return self.data
+
+    def write(self):
+        writeJson(self.path, self.load(), prefix='.snapshot-history-', indent=2, folderMode=0o700)
+
+    def record(self, branch, target, peakBytes):
+        entries = self.load().setdefault(self.__getRowKey(branch, target), [])
+        entries.append({
+            'time': time.time(),
+            'peakBytes': peakBytes,
+        })
+
+        length = int(self.configHelper.getGlobalOption('snap_history_length', 14))
+        del entries[0:max(0, len(entries) - length)]
+
+    def recordMetrics(self, metrics):
+        for snapshot in metrics.toDict()['snapshots']:
+            self.record(snapshot['branch'], snapshot['target'], snapshot['peakBytes'])
+
+    def getAutoSize(self, index):
+        # Returns the size in bytes to use for a snapshot of the row
+        tableLine = self.config.table[index]
+        entries = self.load().get(self.__getRowKey(tableLine.branch, tableLine.target), [])
+        if len(entries) == 0:
+            return self.configHelper.getParsedSize(self.configHelper.getOption(index, 'snap_auto_initial', '1g'))
+        
+        # Fill rates of short runs cannot be applied to the duration of long ones, so stick to the peaks seen
+        expected = max(e['peakBytes'] for e in entries)
+
+        margin = float(self.configHelper.getOption(index, 'snap_auto_margin', 50))
+        minSize = self.configHelper.getParsedSize(self.configHelper.getOption(index, 'snap_auto_min', '256m'))
+        size = max(expected * (1 + margin / 100), minSize)
+
+        # Full MB
+        mb = 1024 * 1024
+        return math.ceil(size / mb) * mb
@@ -0,0 +1,152 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bup_backup
+from .helpers.config_helper import ConfigHelper
+
+import math
+import threading
+import time
+
+class SnapshotMonitor:
+    def __init__(self, config: bup_backup.config.BackupConfig, verbose: bool, dry: bool, debug: bool, metrics=None):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+        self.metrics = metrics
+
+        self.verbose = verbose
+        self.dry = dry
+        self.debug = debug
+
+        self.lock = threading.Lock()
+        self.pollLock = threading.Lock()
+        self.snapshots = {}
+        self.headroom = {}
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+        self.interval = float(self.configHelper.getGlobalOption('snap_monitor_interval', 10))
+        self.threshold = float(self.configHelper.getGlobalOption('snap_extend_threshold', 80))
+        self.extendPercent = float(self.configHelper.getGlobalOption('snap_extend_percent', 20))
+
+    def setHeadroom(self, headroom: dict):
+        # Space per VG that can be used to extend snapshots without affecting other reservations
+        with self.lock:
+            self.headroom = dict(headroom)
+
+    def register(self, index, snapName):
+        if self.dry:
+            return
+        with self.lock:
+            self.snapshots[snapName] = {
+                'index': index,
+                'started': time.monotonic(),
+                'peakPercent': 0.0,
+                'peakBytes': 0,
+                'extendedBytes': 0,
+                'warned': False,
+            }
+
+    def unregister(self, snapName):
+        if self.dry:
+            return
+        
+        # A last check to catch the usage since the last poll
+        self.__poll([snapName])
+
+        with self.lock:
+            snapshot = self.snapshots.pop(snapName, None)
+        if snapshot is None:
+            return
+        
+        duration = time.monotonic() - snapshot['started']
+        if self.verbose:
+            print(f"Snapshot {snapName} was filled up to {snapshot['peakPercent']:.1f}% in {duration:.1f}s.")
+        if self.metrics is not None:
+            self.metrics.addSnapshotUsage(
+                self.config.table[snapshot['index']], snapName,
+                snapshot['peakPercent'], snapshot['peakBytes'], snapshot['extendedBytes'], duration
+            )
+
+    def start(self):
+        if self.dry or self.interval <= 0:
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.__run, name='snapshot-monitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+
+    def __run(self):
+        while not self.stopEvent.wait(self.interval):
+            with self.lock:
+                names = list(self.snapshots.keys())
+            if len(names) > 0:
+                self.__poll(names)
+
+    def __poll(self, names):
+        lv = bup_backup.lvm.Lv()
+        vg = bup_backup.lvm.Vg()
+        with self.pollLock:
+            try:
+                # Fresh values are needed
+                lv.metadata.invalidate()
+                for snapName in names:
+                    self.__check(lv, vg, snapName)
+            except Exception as e:
+                print(f'Warning: Monitoring of the snapshots failed: {e}')
+
+    def __check(self, lv, vg, snapName):
+        if not vg.hasLv(snapName):
+            return
+        percent = lv.getDataPercent(snapName)
+        if percent is None:
+            return
+        size = lv.getSize(snapName)
+
+        with self.lock:
+            snapshot = self.snapshots.get(snapName)
+            if snapshot is None:
+                return
+            if percent > snapshot['peakPercent']:
+                snapshot['peakPercent'] = percent
+            snapshot['peakBytes'] = max(snapshot['peakBytes'], int(size * percent / 100))
+
+            if self.debug:
+                print(f'Snapshot {snapName} is filled to {percent:.1f}%.')
+            
+            if percent < self.threshold:
+                return
+            
+            vgName = lv.getVgName(snapName)
+            peSize = vg.getPeSize(vgName)
+            amount = math.ceil(max(size * self.extendPercent / 100, peSize) / peSize) * peSize
+            if self.headroom.get(vgName, 0) < amount:
+                if not snapshot['warned']:
+                    print(f'Warning: Snapshot {snapName} is filled to {percent:.1f}% but there is no headroom left in VG {vgName} to extend it.')
+                    snapshot['warned'] = True
+                return
+            
+            self.headroom[vgName] -= amount
+            snapshot['extendedBytes'] += amount
+        
+        lv.extend(snapName, amount, dry=self.dry, verbose=self.verbose, debug=self.debug)
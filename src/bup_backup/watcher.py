@@ -0,0 +1,481 @@
+"""
+    Copyright (C) 2022 Christian Wolf
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bup_backup
+from .helpers.abstract_processing_helper import ConfigurationException
+from .helpers.config_helper import ConfigHelper
+from .helpers.atomic_file import writeJson
+
+import ctypes
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import select
+import signal
+import struct
+import time
+
+class DirtyStore:
+    def __init__(self, config: bup_backup.config.BackupConfig):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+
+    def getPath(self, index):
+        folder = self.configHelper.getGlobalOption('watch_dir', '/var/lib/bup-backup/watch')
+        dynPart = f'{self.config.table[index].branch}:{self.config.table[index].target}'
+        return os.path.join(folder, f'{hashlib.md5(dynPart.encode()).hexdigest()}.json')
+
+    def __getEmptyData(self):
+        return {
+            'started': None,
+            'heartbeat': None,
+            'overflow': False,
+            'synced': None,
+            'dirs': [],
+            'trees': [],
+        }
+
+    def __read(self, path):
+        if not os.path.exists(path):
+            return self.__getEmptyData()
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    def __write(self, path, data):
+        writeJson(path, data, prefix='.watch-', folderMode=0o700)
+
+    def __update(self, index, callback):
+        # Watcher and backup run in different processes. All changes are serialized by a lock file.
+        path = self.getPath(index)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(f'{path}.lock', 'a') as lockFp:
+            fcntl.flock(lockFp.fileno(), fcntl.LOCK_EX)
+            data = self.__read(path)
+            ret = callback(data)
+            self.__write(path, data)
+            return ret
+
+    def load(self, index):
+        return self.__read(self.getPath(index))
+
+    def start(self, index, started):
+        def callback(data):
+            data.update(self.__getEmptyData())
+            data['started'] = started
+            data['heartbeat'] = started
+        self.__update(index, callback)
+
+    def stop(self, index):
+        def callback(data):
+            data['started'] = None
+        self.__update(index, callback)
+
+    def merge(self, index, dirs, trees, overflow, heartbeat):
+        def callback(data):
+            data['dirs'] = sorted(set(data['dirs']).union(dirs))
+            data['trees'] = sorted(set(data['trees']).union(trees))
+            data['overflow'] = data['overflow'] or overflow
+            data['heartbeat'] = heartbeat
+        self.__update(index, callback)
+
+    def isUsable(self, index, data, token):
+        # The dirty paths are only complete if the same watcher run was active since the last sync
+        if data['started'] is None or data['overflow']:
+            return False
+        if data['synced'] != f"{data['started']}|{token}":
+            return False
+
+        timeout = float(self.configHelper.getOption(index, 'watch_heartbeat_timeout', 60))
+        if data['heartbeat'] is None or time.time() - data['heartbeat'] > timeout:
+            return False
+
+        maxPaths = int(self.configHelper.getOption(index, 'watch_max_paths', 10000))
+        if len(data['dirs']) + len(data['trees']) > maxPaths:
+            return False
+
+        return True
+
+    def take(self, index, token):
+        # Returns the dirty paths collected so far and starts a new collection
+        def callback(data):
+            old = dict(data)
+            usable = self.isUsable(index, old, token)
+            data['dirs'] = []
+            data['trees'] = []
+            data['overflow'] = False
+            data['synced'] = f"{data['started']}|{token}"
+            return (old, usable)
+        return self.__update(index, callback)
+
+    def restore(self, index, old):
+        # The sync failed. Put the paths back and force a full walk next time.
+        def callback(data):
+            data['dirs'] = sorted(set(data['dirs']).union(old['dirs']))
+            data['trees'] = sorted(set(data['trees']).union(old['trees']))
+            data['overflow'] = data['overflow'] or old['overflow']
+            data['synced'] = None
+        self.__update(index, callback)
+
+class InotifySource:
+    __IN_NONBLOCK = 0o4000
+    __IN_CLOEXEC = 0o2000000
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_EXCL_UNLINK = 0x4000000
+    IN_ISDIR = 0x40000000
+
+    __MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+        IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+    )
+    __EVENT = struct.Struct('=iIII')
+
+    def __init__(self, debug):
+        self.debug = debug
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.__IN_NONBLOCK | self.__IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'inotify_init1: {os.strerror(e)}')
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def addTree(self, path):
+        # Returns False if not all folders could be watched
+        complete = True
+        device = os.lstat(path).st_dev
+        stack = [path]
+        while len(stack) > 0:
+            current = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), self.__MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                if self.debug:
+                    print(f'Cannot watch {current}: {os.strerror(e)}')
+                complete = False
+                continue
+            self.watches[wd] = current
+
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        # Like rsync -x, other file systems are not entered
+                        if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_dev == device:
+                            stack.append(entry.path)
+            except OSError:
+                pass
+        return complete
+
+    def read(self):
+        # Yields tuples (folder, name, isNewDir, incomplete)
+        try:
+            buf = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = self.__EVENT.unpack_from(buf, offset)
+            name = buf[offset + self.__EVENT.size:offset + self.__EVENT.size + length].rstrip(b'\0')
+            offset += self.__EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                yield (None, None, False, True)
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            name = os.fsdecode(name)
+
+            isNewDir = (mask & self.IN_ISDIR) != 0 and (mask & (self.IN_CREATE | self.IN_MOVED_TO)) != 0
+            incomplete = False
+            if isNewDir:
+                # The new folder needs to be watched as well. Events inside it before that are
+                # covered as the whole new tree is synchronized.
+                incomplete = not self.addTree(os.path.join(folder, name))
+            yield (folder, name, isNewDir, incomplete)
+
+    def close(self):
+        os.close(self.fd)
+
+class FanotifySource:
+    __FAN_CLOEXEC = 0x1
+    __FAN_NONBLOCK = 0x2
+    __FAN_REPORT_DFID_NAME = 0xc00
+    __FAN_MARK_ADD = 0x1
+    __FAN_MARK_FILESYSTEM = 0x100
+    __AT_FDCWD = -100
+
+    FAN_MODIFY = 0x2
+    FAN_ATTRIB = 0x4
+    FAN_CLOSE_WRITE = 0x8
+    FAN_MOVED_FROM = 0x40
+    FAN_MOVED_TO = 0x80
+    FAN_CREATE = 0x100
+    FAN_DELETE = 0x200
+    FAN_Q_OVERFLOW = 0x4000
+    FAN_ONDIR = 0x40000000
+
+    __MASK = FAN_MODIFY | FAN_ATTRIB | FAN_CLOSE_WRITE | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE | FAN_DELETE | FAN_ONDIR
+    __EVENT = struct.Struct('=IBBHQii')
+    __INFO_HEADER = struct.Struct('=BBH')
+    __FILE_HANDLE = struct.Struct('=Ii')
+    __INFO_DFID_NAME = 2
+
+    def __init__(self, debug):
+        self.debug = debug
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        self.fd = self.libc.fanotify_init(self.__FAN_REPORT_DFID_NAME | self.__FAN_CLOEXEC | self.__FAN_NONBLOCK, os.O_RDONLY)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'fanotify_init: {os.strerror(e)}')
+        self.mountFds = {}
+        self.fsidMap = {}
+
+    def fileno(self):
+        return self.fd
+
+    def addTree(self, path):
+        # The whole file system is watched. Events outside the tree are filtered later.
+        device = os.lstat(path).st_dev
+        if device in self.mountFds:
+            return True
+        
+        ret = self.libc.fanotify_mark(self.fd, self.__FAN_MARK_ADD | self.__FAN_MARK_FILESYSTEM, self.__MASK, self.__AT_FDCWD, os.fsencode(path))
+        if ret < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'fanotify_mark on {path}: {os.strerror(e)}')
+        self.mountFds[device] = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        return True
+
+    def __resolve(self, fsid, handle):
+        # Returns the path of the folder, None if it is gone or False if it cannot be resolved
+        candidates = [self.fsidMap[fsid]] if fsid in self.fsidMap else list(self.mountFds.values())
+        gone = False
+        for mountFd in candidates:
+            fd = self.libc.open_by_handle_at(mountFd, ctypes.create_string_buffer(handle, len(handle)), os.O_PATH)
+            if fd < 0:
+                gone = gone or ctypes.get_errno() == errno.ESTALE
+                continue
+            try:
+                path = os.readlink(f'/proc/self/fd/{fd}')
+            finally:
+                os.close(fd)
+            self.fsidMap[fsid] = mountFd
+            if path.endswith(' (deleted)'):
+                return None
+            return path
+        
+        if gone:
+            return None
+        return False
+
+    def read(self):
+        # Yields tuples (folder, name, isNewDir, incomplete)
+        try:
+            buf = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + self.__EVENT.size <= len(buf):
+            eventLen, vers, reserved, metadataLen, mask, fd, pid = self.__EVENT.unpack_from(buf, offset)
+            event = buf[offset:offset + eventLen]
+            offset += eventLen
+
+            if mask & self.FAN_Q_OVERFLOW:
+                yield (None, None, False, True)
+                continue
+
+            infoOffset = metadataLen
+            while infoOffset + self.__INFO_HEADER.size <= len(event):
+                infoType, pad, infoLen = self.__INFO_HEADER.unpack_from(event, infoOffset)
+                info = event[infoOffset:infoOffset + infoLen]
+                infoOffset += infoLen
+                if infoLen == 0:
+                    break
+                if infoType != self.__INFO_DFID_NAME:
+                    continue
+
+                fsid = info[4:12]
+                handleBytes, handleType = self.__FILE_HANDLE.unpack_from(info, 12)
+                handleEnd = 12 + self.__FILE_HANDLE.size + handleBytes
+                handle = info[12:handleEnd]
+                name = os.fsdecode(info[handleEnd:].split(b'\0', 1)[0])
+
+                folder = self.__resolve(fsid, handle)
+                if folder is None:
+                    # The folder is gone. Its deletion is reported to the parent folder.
+                    continue
+                if folder is False:
+                    if self.debug:
+                        print('Cannot resolve the folder of a fanotify event.')
+                    yield (None, None, False, True)
+                    continue
+
+                isNewDir = (mask & self.FAN_ONDIR) != 0 and (mask & (self.FAN_CREATE | self.FAN_MOVED_TO)) != 0
+                yield (folder, name, isNewDir, False)
+
+    def close(self):
+        for fd in self.mountFds.values():
+            os.close(fd)
+        os.close(self.fd)
+
+class DirtyWatcher:
+    def __init__(self, config: bup_backup.config.BackupConfig, verbose: bool, debug: bool):
+        self.config = config
+        self.configHelper = ConfigHelper(config)
+        self.store = DirtyStore(config)
+
+        self.verbose = verbose
+        self.debug = debug
+
+        self.rows = {}
+        self.pending = {}
+
+    def getWatchedRows(self):
+        ret = []
+        for index in range(0, len(self.config.table)):
+            if self.config.table[index].type != 'plain':
+                continue
+            if self.configHelper.getOption(index, 'staging', 'rsync') != 'rsync':
+                continue
+            if self.configHelper.getBoolOption(index, 'watch'):
+                ret.append(index)
+        return ret
+
+    def __createSource(self):
+        method = self.configHelper.getGlobalOption('watch_method', 'auto')
+        if method in ('auto', 'fanotify'):
+            try:
+                source = FanotifySource(self.debug)
+                for index in self.rows.keys():
+                    source.addTree(self.rows[index])
+                if self.verbose:
+                    print('Watching the file systems using fanotify.')
+                return source
+            except OSError as e:
+                if method == 'fanotify':
+                    raise
+                if self.verbose:
+                    print(f'Cannot use fanotify ({e}). Falling back to inotify.')
+        elif method != 'inotify':
+            raise ConfigurationException(f'The watch method {method} is unknown.')
+        
+        source = InotifySource(self.debug)
+        for index in self.rows.keys():
+            if self.verbose:
+                print(f'Adding inotify watches for {self.rows[index]}.')
+            if not source.addTree(self.rows[index]):
+                self.__getPending(index)['overflow'] = True
+        return source
+
+    def __getPending(self, index):
+        return self.pending.setdefault(index, {'dirs': set(), 'trees': set(), 'overflow': False})
+
+    def __handleEvent(self, folder, name, isNewDir, incomplete):
+        for index, source in self.rows.items():
+            if folder is None:
+                # Queue overflow, events of any row might be lost
+                self.__getPending(index)['overflow'] = True
+                continue
+
+            if os.path.join(folder, name) == source:
+                # The root folder of the row itself was changed
+                self.__getPending(index)['dirs'].add('')
+                continue
+            if folder != source and not folder.startswith(f'{source}/'):
+                continue
+            
+            rel = folder[len(source) + 1:]
+            pending = self.__getPending(index)
+            pending['dirs'].add(rel)
+            if isNewDir:
+                pending['trees'].add(os.path.join(rel, name))
+            if incomplete:
+                pending['overflow'] = True
+
+    def __flush(self):
+        now = time.time()
+        for index in self.rows.keys():
+            pending = self.pending.pop(index, None)
+            if pending is None:
+                pending = {'dirs': set(), 'trees': set(), 'overflow': False}
+            if self.debug and (len(pending['dirs']) > 0 or len(pending['trees']) > 0):
+                print(f'Dirty paths of {self.rows[index]}:', sorted(pending['dirs']), sorted(pending['trees']))
+            self.store.merge(index, pending['dirs'], pending['trees'], pending['overflow'], now)
+
+    def __terminate(self, signum, frame):
+        raise SystemExit(0)
+
+    def run(self):
+        for index in self.getWatchedRows():
+            self.rows[index] = os.path.realpath(self.config.table[index].source)
+        if len(self.rows) == 0:
+            raise ConfigurationException('There are no rows with the watch option in the table.')
+        
+        interval = float(self.configHelper.getGlobalOption('watch_flush_interval', 10))
+        signal.signal(signal.SIGTERM, self.__terminate)
+
+        source = self.__createSource()
+        try:
+            # Only from now on, no change can be missed.
+            started = time.time()
+            for index in self.rows.keys():
+                self.store.start(index, started)
+            self.__flush()
+
+            if self.verbose:
+                print(f'Watching {len(self.rows)} rows for changes.')
+            
+            lastFlush = time.monotonic()
+            while True:
+                timeout = max(0, lastFlush + interval - time.monotonic())
+                readable, w, x = select.select([source], [], [], timeout)
+                if len(readable) > 0:
+                    for folder, name, isNewDir, incomplete in source.read():
+                        self.__handleEvent(folder, name, isNewDir, incomplete)
+                
+                if time.monotonic() - lastFlush >= interval:
+                    self.__flush()
+                    lastFlush = time.monotonic()
+        finally:
+            self.__flush()
+            for index in self.rows.keys():
+                self.store.stop(index)
+            source.close()
@@ -32,25 +32,48 @@ def main():
     parser.parseCommonConfig(cli.getCommonConfigName(), config)
     parser.parseConfigTable(cli.getTableName(), config)
 
+    if len(cli.getBranches()) > 0:
+        config.table = [row for row in config.table if row.branch in cli.getBranches()]
+        if len(config.table) == 0:
+            raise bup_backup.helpers.abstract_processing_helper.ConfigurationException(f'There are no rows for the branches {cli.getBranches()} in the table.')
+
     sorter = bup_backup.config.BackupConfigSorter()
     config = sorter.sort(config)
     
     if cli.isShowDebug():
         print('Total configuration', config.__dict__)
     
-    bup = bup_backup.bup.Bup(config, verbose=cli.isVerbose(), dry=cli.isDryRun(), debug=cli.isShowDebug())
+    if cli.isWatch():
+        watcher = bup_backup.watcher.DirtyWatcher(config, verbose=cli.isVerbose(), debug=cli.isShowDebug())
+        watcher.run()
+        return
+
+    journal = bup_backup.journal.RunJournal(config, dry=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug())
+    if cli.isResume():
+        journal.load()
+    else:
+        journal.reset()
+
+    metrics = bup_backup.metrics.RunMetrics()
+    bup = bup_backup.bup.Bup(config, verbose=cli.isVerbose(), dry=cli.isDryRun(), debug=cli.isShowDebug(), journal=journal, metrics=metrics)
     workDir = bup_backup.helpers.workdir.Workdir(config)
+    snapshotMonitor = bup_backup.snapshot_monitor.SnapshotMonitor(config, verbose=cli.isVerbose(), dry=cli.isDryRun(), debug=cli.isShowDebug(), metrics=metrics)
 
     bup.check()
 
     helperMap = {
-        'plain': bup_backup.helpers.PlainProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug()),
-        'command': bup_backup.helpers.CommandProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug()),
-        'lvm': bup_backup.helpers.LVMProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug()),
-        # 'crypt': bup_backup.helpers.LVMProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug()),
-        'lvm+crypt': bup_backup.helpers.LVMCryptProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug()),
+        'plain': bup_backup.helpers.PlainProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal),
+        'command': bup_backup.helpers.CommandProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal),
+        'lvm': bup_backup.helpers.LVMProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal, snapshotMonitor=snapshotMonitor),
+        # 'crypt': bup_backup.helpers.LVMProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal),
+        'lvm+crypt': bup_backup.helpers.LVMCryptProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal, snapshotMonitor=snapshotMonitor),
+        'lvm-raw': bup_backup.helpers.LVMRawProcessingHelper(config, dryRun=cli.isDryRun(), verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal, snapshotMonitor=snapshotMonitor),
     }
 
+    if cli.isResume():
+        for index in reversed(range(0, len(config.table))):
+            helperMap[config.table[index].type].cleanUpLeftovers(index)
+
     for index in range(0, len(config.table)):
         helper = helperMap[config.table[index].type]
         
@@ -58,47 +81,70 @@ def main():
             print(f'Checking entry {index} in table: {config.table[index].source}')
         helper.checkConfig(index)
     
-    lvmSizeChecker = bup_backup.helpers.LvmConfigChecker(config)
+    configHelper = bup_backup.helpers.config_helper.ConfigHelper(config)
+    jobs = cli.getJobs()
+    if jobs is None:
+        jobs = int(configHelper.getGlobalOption('prepare_jobs', 1))
+
+    pipelined = cli.isPipelined() or configHelper.getBoolGlobalOption('pipeline')
+
+    lvmSizeChecker = bup_backup.helpers.LvmConfigChecker(config, parallelJobs=jobs)
     lvmSizeChecker.checkFreeSpace()
+    snapshotMonitor.setHeadroom(lvmSizeChecker.getVgHeadroom())
 
     if cli.isVerbose():
         print('Finished the checks. Starting backup preparations.')
     
     tic = time.monotonic()
+    snapshotMonitor.start()
 
-    for index in range(0, len(config.table)):
-        helper = helperMap[config.table[index].type]
-
+    def cleanUpBranch(branch):
         if cli.isVerbose():
-            print(f"Prepare step for backing up {config.table[index].source}.")
-        
-        helper.prepareBackup(index)
+            print(f'Branch {branch} is saved. Cleaning up its backup work now.')
 
-        if cli.isVerbose():
-            print(f"Backup preparation step for {config.table[index].source} completed.")
-    
-    if cli.isVerbose():
-        print('Starting bup backup process.')
-    
-    workPath = workDir.getWorkingBasePath()
-    bup.index(workPath)
-    bup.save(workPath)
+        # Nested targets need to be released before their parents
+        for index in reversed(range(0, len(config.table))):
+            if config.table[index].branch != branch:
+                continue
+            
+            helper = helperMap[config.table[index].type]
 
-    if cli.isVerbose():
-        print('Finished bup backup process. Cleaning up backup work now.')
+            if cli.isVerbose():
+                print(f"Clean up after backing up {config.table[index].source}.")
+            
+            helper.cleanUpBackup(index)
 
-    for index in range(0, len(config.table)):
-        helper = helperMap[config.table[index].type]
+            if cli.isVerbose():
+                print(f"Cleanup step for {config.table[index].source} completed.")
+
+    scheduler = bup_backup.scheduler.PrepareScheduler(config, helperMap, jobs, verbose=cli.isVerbose(), debug=cli.isShowDebug(), journal=journal, metrics=metrics)
+    workPath = workDir.getWorkingBasePath()
 
+    if pipelined:
+        for branch in scheduler.runByBranch():
+            if journal.isBranchSaved(branch):
+                continue
+            if cli.isVerbose():
+                print(f'Starting bup backup process for branch {branch}.')
+            bup.indexBranch(workPath, branch)
+            bup.submitSave(workPath, branch, cleanUpBranch)
+        bup.waitForSaves()
+    else:
+        scheduler.run()
+    
         if cli.isVerbose():
-            print(f"Clean up after backing up {config.table[index].source}.")
+            print('Starting bup backup process.')
         
-        helper.cleanUpBackup(index)
+        bup.index(workPath)
+        bup.save(workPath, cleanUpBranch)
 
-        if cli.isVerbose():
-            print(f"Cleanup step for {config.table[index].source} completed.")
+    snapshotMonitor.stop()
+
+    if cli.isVerbose():
+        print('Finished bup backup process.')
     
     bup.finishBackup()
+    journal.finish()
     
     if cli.isVerbose():
         print('Finished clean up.')
@@ -120,7 +166,19 @@ def main():
             tictoc = f"{tictocHours}h {tictoc}"
         
         print(f"Finished processing the backups in {tictoc}")
+        metrics.printSummary()
+    
+    if not cli.isDryRun() and len(metrics.snapshots) > 0:
+        # The usage of the snapshots is needed for snap_size = auto
+        history = bup_backup.snapshot_history.SnapshotHistory(config)
+        history.recordMetrics(metrics)
+        history.write()
+
+    metricsFile = configHelper.getGlobalOption('metrics_file', '')
+    if metricsFile != '' and not cli.isDryRun():
+        metrics.write(metricsFile)
     
+    return metrics
 
 if __name__ == '__main__':
     main()